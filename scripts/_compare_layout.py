@@ -20,6 +20,7 @@ import numpy as np
 import argparse
 import logging
 
+from correct_for_demography import model_results
 # from util import delimiter_dict
 # from verify_ports import get_ports
 # compare_port= get_ports('compare_port')
@@ -146,7 +147,7 @@ def display_model(region, outDir):
 
     print(f'\nDisplaying GLM fitting on {region}')
 
-    res = sm.load_pickle(pjoin(outDir, f'.{region}.pkl'))
+    res = model_results(outDir, region)
 
     fig = make_subplots(
         rows=2, cols=2,
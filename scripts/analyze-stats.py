@@ -13,8 +13,9 @@ import numpy as np
 import argparse
 import logging
 
-from util import delimiter_dict
+from util import delimiter_dict, read_table, write_table, table_name
 from verify_ports import get_ports
+from pipeline import run_stage
 graphs_port= get_ports('graphs_port')
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -134,20 +135,26 @@ if __name__ == '__main__':
     # df = pd.read_csv('C://Users/tashr/Documents/aparcstats_lh.csv')
     # outDir = 'C://Users/tashr/Documents/fs-stats-aparc/'
 
-    df = pd.read_csv(abspath(args.input),sep=delimiter_dict[args.delimiter])
+    df = read_table(abspath(args.input), delimiter_dict[args.delimiter])
     regions = df.columns.values[1:]
     subjects = df[df.columns[0]].values
 
-    # generate all figures
-    df_inliers= df.copy()
-    for column_name in regions:
-        print(column_name)
-        _, inliers, zscores= plot_graph(column_name, args.extent)
+    def write_outliers():
+        # generate all figures
+        df_inliers= df.copy()
+        for column_name in regions:
+            print(column_name)
+            _, inliers, zscores= plot_graph(column_name, args.extent)
 
-        # write outlier summary
-        df_inliers[column_name] = zscores
+            # write outlier summary
+            df_inliers[column_name] = zscores
 
-    df_inliers.to_csv(pjoin(outDir, 'outliers.csv'), index=False)
+        write_table(df_inliers, outliers)
+
+    # outliers are not computed again if neither input nor parameters have changed
+    outliers= table_name(pjoin(outDir, 'outliers'))
+    run_stage('analyze-stats', write_outliers, [abspath(args.input)], [outliers],
+              {'delimiter': args.delimiter, 'extent': args.extent}, outDir)
 
     app.layout = html.Div([
 
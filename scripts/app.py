@@ -1,39 +1,43 @@
 #!/usr/bin/env python
 
-import base64, io
+import base64
+import json
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 from dash_table import DataTable
 from dash.exceptions import PreventUpdate
 from os.path import isfile, isdir, abspath, join as pjoin, dirname, splitext, basename
 from os import makedirs, getenv, remove, listdir
-from scipy.spatial.distance import mahalanobis
-from scipy.stats import scoreatpercentile
-from sklearn.ensemble import IsolationForest
 
 import pandas as pd
 import numpy as np
 import argparse
 import logging
 
-from subprocess import check_call
-
 from _table_layout import plot_graph, show_table
-from view_roi import load_lut, render_roi
+from view_roi import roi_sources
 from _compare_layout import plot_graph_compare, display_model
+from scan_subjects import lookup
+from scores import summarize, multivariate
+from batch import correct_table, write_zscores
+from pipeline import cached_stage, cached_result, content_hash, file_hash
+from model_store import model_regions
+from results_db import store_run, find_run, summary as stored_summary, score_table
+from watch import watch_version, watch_extent, WATCH_INTERVAL
+from feature_matrix import residualize, zscore_matrix, outlier_summary, num_pages, page as feature_page, PAGE_SIZE
 
-from util import delimiter_dict, _glob
+from util import delimiter_dict, _glob, read_table, write_table, write_later, table_name
 
 SCRIPTDIR=dirname(abspath(__file__))
+# the last analysis of outDir, to be reopened after the app restarts
+SESSION='.session.json'
 
 # initial list of items
 init_dir= getenv("INIT_DIR",'/')
 df=pd.DataFrame(columns=[init_dir], data=_glob(init_dir))
 
-CONTAMIN=.05
-
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets, suppress_callback_exceptions=True,
                 title='Outlier detection')
@@ -87,7 +91,8 @@ other statistics having a summary table such as those obtained from Tract-Based
                 html.Summary('From PNL server'),
 
                 html.Div(className='type-inst', children=[
-                    'Select a csv/tsv/txt file from the file browser below--',
+                    'Select a csv/tsv/txt/parquet/feather file, or a feature matrix (.npy) written by '
+                    'feature_matrix.py, from the file browser below--',
                 ]),
 
 
@@ -232,7 +237,7 @@ other statistics having a summary table such as those obtained from Tract-Based
                 html.Summary('From PNL server'),
                 
                 html.Div(className='type-inst', children=[
-                    'Select a csv/tsv/txt file from the file browser below--',
+                    'Select a csv/tsv/txt/parquet/feather file from the file browser below--',
                 ]),
 
 
@@ -349,7 +354,11 @@ other statistics having a summary table such as those obtained from Tract-Based
             html.Button(id='analyze',
                         n_clicks_timestamp=0,
                         children='Analyze',
-                        title='Analyze text file to detect outliers')],
+                        title='Analyze text file to detect outliers'),
+            html.Button(id='reopen',
+                        n_clicks_timestamp=0,
+                        children='Reopen results',
+                        title='Show the last analysis saved in the output directory without analyzing again')],
             style={'float': 'center', 'display': 'inline-block'}),
 
         dcc.Loading(id='parse summary and compute zscore', fullscreen= True, debug=True, type='graph'),
@@ -358,12 +367,25 @@ other statistics having a summary table such as those obtained from Tract-Based
         dcc.Store(id='df'),
         dcc.Store(id='subjects'),
         dcc.Store(id='dfcombined'),
+        dcc.Store(id='matrix'),
+        # {'corrected': bool} of the analysis shown
+        dcc.Store(id='session'),
+        # modification time of outDir/.watch.json, see watch.py
+        dcc.Store(id='watch-version'),
+        dcc.Interval(id='watch-interval', interval=WATCH_INTERVAL*1000),
         # other dcc.Store()
 
         html.Br(),
         html.Div(id='results', children=[
             html.Div('Analysis complete! Now you can browse through the summary below!', id='analyze-status'),
             html.Br(),
+            # a feature matrix is browsed one page of features at a time
+            html.Div(id='feature-paging', children=[
+                'Page of features ',
+                dcc.Input(id='feature-page', type='number', min=0, value=0, debounce=True),
+                html.Div(id='feature-range'),
+                html.Br()
+            ], style={'display': 'none'}),
             dcc.Link('See outliers summary', href='/summary'),
             html.Br(),
             dcc.Link('See outliers in graphs and GLM fitting', id='compare-link', style={'display': 'none'}, href='/compare'),
@@ -903,38 +925,65 @@ def activate_analyze(value):
 # but hooking it up to 'analyze' button click while bypassing analyze() callback can be hard
 
 
+def load_cached(contents, filename, server_filename, delimiter, outDir):
+    '''
+    Read an uploaded or server table, once for the same content and delimiter, see pipeline.cached_stage()
+    :return: table, and content hash of the table and delimiter
+    '''
+
+    if server_filename:
+        key= content_hash(file_hash(server_filename), splitext(server_filename)[1], delimiter)
+        read= lambda: read_table(server_filename, delimiter_dict[delimiter])
+
+    else:
+        # uploads are hashed as they are received, so they are decoded only for a new content
+        key= content_hash(contents, splitext(filename)[1], delimiter)
+        read= lambda: read_table(filename, delimiter_dict[delimiter], base64.b64decode(contents.split(',')[1]))
+
+    return cached_stage('table', key, lambda: (read(), []), outDir), key
+
+
 # callback for input_layout / GLM analysis
 # df.data will hold residuals=predicted-given
 # dfcombined.data will hold a combined DataFrame of given and demographics
 @app.callback([Output('region', 'options'), Output('region-compare', 'options'),
                Output('df', 'data'), Output('dfcombined','data'), Output('subjects','data'),
-               Output('parse summary and compute zscore', 'children'), Output('analyze-status', 'style')],
+               Output('parse summary and compute zscore', 'children'), Output('analyze-status', 'style'),
+               Output('matrix', 'data'), Output('feature-paging', 'style'), Output('feature-range', 'children'),
+               Output('session', 'data')],
               [Input('csv','contents'), Input('csv','filename'), Input('listdir', 'columns'),
-               Input('participants','contents'), Input('listdir-dgraph', 'columns'),
+               Input('participants','contents'), Input('participants','filename'), Input('listdir-dgraph', 'columns'),
                Input('delimiter','value'), Input('outDir', 'value'),
                Input('effect','value'), Input('control','value'),
-               Input('analyze', 'n_clicks')])
-def analyze(raw_contents, filename, server_filename, dgraph_contents, dgraph_server_filename,
-            delimiter, outDir, effect, control, analyze):
+               Input('analyze', 'n_clicks'), Input('feature-page', 'value'), Input('reopen', 'n_clicks')])
+def analyze(raw_contents, filename, server_filename, dgraph_contents, dgraph_filename, dgraph_server_filename,
+            delimiter, outDir, effect, control, analyze, page, reopen):
+
+    changed = [item['prop_id'] for item in dash.callback_context.triggered][0]
+    if 'reopen' in changed or (reopen and not analyze and 'feature-page' in changed):
+        return reopen_session(outDir, page)
 
     if not analyze:
         raise PreventUpdate
     
     server_filename= server_filename[0]['id']
+    if server_filename.endswith('.npy') and isfile(server_filename):
+        return analyze_matrix(server_filename, dgraph_contents, dgraph_filename, dgraph_server_filename,
+                              delimiter, outDir, effect, control, page)
+
+    outDir= abspath(outDir)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
+
     if isfile(server_filename):
         # load from PNL server
-        df=pd.read_csv(server_filename, sep=delimiter_dict[delimiter])
+        df, key= load_cached(None, None, server_filename, delimiter, outDir)
         filename= basename(server_filename)
 
     else:
         # load from your computer
-        _, contents = raw_contents.split(',')
-        decoded = base64.b64decode(contents)
-        df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), sep=delimiter_dict[delimiter])
-
-    outDir= abspath(outDir)
-    if not isdir(outDir):
-        makedirs(outDir, exist_ok= True)
+        df, key= load_cached(raw_contents, filename, None, delimiter, outDir)
+    prefix= splitext(filename)[0]
 
 
     tmp= dgraph_server_filename[0]['id']
@@ -944,90 +993,189 @@ def analyze(raw_contents, filename, server_filename, dgraph_contents, dgraph_ser
         dgraph_server_filename= None
         
     if dgraph_contents or dgraph_server_filename:
-        # when loaded through dcc.Upload(), Dash app will not have any knowledge of input path
-        # so save the content of filename in outDir so that can be used for further analysis
-        summaryCsv= pjoin(outDir, filename)
-        df.to_csv(summaryCsv, index= False)
-
-        if dgraph_server_filename:
-            dgraph_server_filename= dgraph_server_filename
-            df= pd.read_csv(dgraph_server_filename, sep=delimiter_dict[delimiter])
-
-        else:
-            _, contents = dgraph_contents.split(',')
-            decoded = base64.b64decode(contents)
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')), sep=delimiter_dict[delimiter])
-
-        partiCsv= pjoin(outDir, '.participants.csv')
-        df.to_csv(partiCsv, index= False)
-
-        exe= pjoin(SCRIPTDIR, 'combine_demography.py')
-        cmd= f'python {exe} -i {summaryCsv} -o {outDir} -p {partiCsv} -c "{control}"'
-        check_call(cmd, shell=True)
-
-
-        # python scripts/correct_for_demography.py -i asegstats_combined.csv -c asegstats_control.csv -e age
-        # -p participants.csv -o dem_corrected/
-        prefix= filename.split('.csv')[0]
-        outPrefix= pjoin(outDir, prefix)
-        exe= pjoin(SCRIPTDIR, 'correct_for_demography.py')
-        cmd= f'python {exe} -i {outPrefix}_combined.csv -c {outPrefix}_control.csv -p {partiCsv} -e "{effect}" ' \
-             f'-o {outDir}'
-        check_call(cmd, shell=True)
-
-        exog = '_'.join(effect.split('+'))
-        residuals= f'{outPrefix}_{exog}_residuals.csv'
+        df_demograph, dkey= load_cached(dgraph_contents, dgraph_filename, dgraph_server_filename, delimiter, outDir)
+
+        # combine_demography.py and correct_for_demography.py in memory, their outputs are saved in outDir,
+        # they are not run again for the same table, participants, control, and effect unless the outputs have changed
+        def correction():
+            df_resid, dfcombined, outputs= correct_table(df, prefix, outDir, df_demograph, control, effect)
+            return (df_resid, dfcombined), outputs
+
+        key= content_hash(key, dkey, prefix, control, effect)
         # raw_contents being overwritten by residuals, our new feature for further analysis
-        df= pd.read_csv(residuals)
+        df, dfcombined= cached_stage('correction', key, correction, outDir)
+
+    else:
+        dfcombined= df
 
-        dfcombined= pd.read_csv(f'{outPrefix}_combined.csv')
+    corrected= bool(dgraph_contents or dgraph_server_filename)
+    df_scores= zscores_stage(df, key, outDir)
+    store_run(outDir, key, df_scores, dfcombined, df if corrected else None, prefix)
+    save_session(outDir, {'corrected': corrected, 'key': key, 'prefix': prefix})
 
+    return table_results(df, dfcombined, corrected)
+
+
+def zscores_stage(df, key, outDir):
+
+    # zscores table is shared by all analyses in outDir, so it is written again only if another one has overwritten it
+    def standardize():
+        df_scores, filename= write_zscores(df, outDir)
+        return df_scores, [filename]
+
+    return cached_stage('zscores', key, standardize, outDir)
+
+
+def table_results(df, dfcombined, corrected):
+    '''
+    :return: outputs of analyze() for a table
+    '''
 
     subjects = df[df.columns[0]].values
     regions = df.columns.values[1:]
     options = [{'label': i, 'value': i} for i in regions]
 
-    # df is reset to residuals
-    filename= pjoin(outDir, 'zscores.csv')
-    df_scores= df.copy()
-    for column_name in regions:
-        print(column_name)
-        _, inliers, zscores= plot_graph(df, column_name)
+    # df.data will hold residuals=predicted-given
+    # dfcombined.data will hold a combined DataFrame of given and demographics, or df itself if not corrected
+    return (options, options,
+            df.to_dict('list'), dfcombined.to_dict('list'), subjects,
+            True, {'display': 'block'}, None, {'display': 'none'}, '', {'corrected': corrected})
 
-        # write outlier summary
-        df_scores[column_name] = zscores
 
+def save_session(outDir, session):
 
-    df_scores.to_csv(filename, index=False)
+    with open(pjoin(outDir, SESSION), 'w') as f:
+        json.dump(session, f)
 
-    # df.data will hold residuals=predicted-given
-    # dfcombined.data will hold a combined DataFrame of given and demographics
-    if dgraph_contents or dgraph_server_filename:
-        return (options, options,
-                df.to_dict('list'), dfcombined.to_dict('list'), subjects,
-                True, {'display': 'block'})
+
+def session_run(outDir):
+    '''
+    :return: id of the run of the last table analysis of outDir in the results database, None for a feature matrix
+    '''
+
+    filename= pjoin(outDir, SESSION)
+    if not isfile(filename):
+        return None
+
+    with open(filename) as f:
+        session= json.load(f)
+
+    return find_run(outDir, session['key']) if 'key' in session else None
+
+
+def reopen_session(outDir, page):
+    '''
+    Show the last analysis saved in outDir without fitting or scoring again: tables are restored from
+    the stage cache, see load_cached(), and feature matrices are memory-mapped
+    '''
+
+    outDir= abspath(outDir)
+    filename= pjoin(outDir, SESSION)
+    if not isfile(filename):
+        print(f'No analysis to reopen in {outDir}, click Analyze')
+        raise PreventUpdate
+
+    with open(filename) as f:
+        session= json.load(f)
+
+    if 'matrix' in session:
+        return matrix_results(session['matrix'], session['scores'], outDir, page, session['corrected'])
+
+    if session['corrected']:
+        df, dfcombined= cached_result('correction', session['key'], outDir) or (None, None)
     else:
-        return (options, options,
-                df.to_dict('list'), df.to_dict('list'), subjects,
-                True, {'display': 'block'})
+        df= dfcombined= cached_result('table', session['key'], outDir)
+
+    if df is None:
+        print(f'Results in {outDir} have changed since the last analysis, click Analyze')
+        raise PreventUpdate
+
+    df_scores= zscores_stage(df, session['key'], outDir)
+    store_run(outDir, session['key'], df_scores, dfcombined, df if session['corrected'] else None,
+              session.get('prefix'))
+
+    return table_results(df, dfcombined, session['corrected'])
+
+
+def analyze_matrix(filename, dgraph_contents, dgraph_filename, dgraph_server_filename, delimiter, outDir, effect,
+                   control, page):
+    '''
+    Residualize and standardize a memory-mapped feature matrix one block of columns at a time,
+    and send only one page of features to the browser, see feature_matrix.py
+    '''
+
+    outDir= abspath(outDir)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
+
+    tmp= dgraph_server_filename[0]['id']
+    dgraph_server_filename= tmp if isfile(tmp) else None
+
+    zfile= pjoin(outDir, 'zscores.npy')
+    scores= pjoin(outDir, 'residuals.npy') if dgraph_contents or dgraph_server_filename else filename
+
+    # turning pages does not require computing scores again
+    changed = [item['prop_id'] for item in dash.callback_context.triggered][0]
+    if not ('feature-page' in changed and isfile(zfile)):
+        if dgraph_contents or dgraph_server_filename:
+            if dgraph_server_filename:
+                df_demograph= read_table(dgraph_server_filename, delimiter_dict[delimiter], converters={0: str})
+            else:
+                _, contents = dgraph_contents.split(',')
+                decoded = base64.b64decode(contents)
+                df_demograph= read_table(dgraph_filename, delimiter_dict[delimiter], decoded, converters={0: str})
+
+            residualize(filename, scores, df_demograph, control, effect)
+
+        zscore_matrix(scores, zfile)
+        save_session(outDir, {'corrected': scores!=filename, 'matrix': filename, 'scores': scores})
+
+    return matrix_results(filename, scores, outDir, page, scores!=filename)
+
+
+def matrix_results(filename, scores, outDir, page, corrected):
+    '''
+    :return: outputs of analyze() for one page of a feature matrix
+    '''
+
+    zfile= pjoin(outDir, 'zscores.npy')
+    last= num_pages(zfile)-1
+    page= min(max(int(page or 0), 0), last)
+
+    df= feature_page(scores, page)
+    dfcombined= feature_page(filename, page)
+    dfcombined= dfcombined[dfcombined['subject'].isin(df['subject'])]
+    # table and ROI views read the page of standard scores
+    write_later(feature_page(zfile, page), table_name(pjoin(outDir, 'zscores')))
+
+    subjects = df[df.columns[0]].values
+    options = [{'label': i, 'value': i} for i in df.columns.values[1:]]
+    num_features= last*PAGE_SIZE+ len(options)
+    feature_range= f'Features {page*PAGE_SIZE}-{page*PAGE_SIZE+len(options)-1} of {num_features}, ' \
+                   f'pages 0-{last}'
+
+    return (options, options,
+            df.to_dict('list'), dfcombined.to_dict('list'), subjects,
+            True, {'display': 'block'}, {'zscores': zfile}, {'display': 'block'}, feature_range,
+            {'corrected': corrected})
 
 
 
 @app.callback([Output('results', 'style'), Output('compare-link', 'style')],
-              [Input('participants','contents'), Input('dfcombined', 'data'), Input('listdir-dgraph', 'columns')])
-def display_link(dgraph_contents, df, dgraph_server_filename):
-    if (dgraph_contents or isfile(dgraph_server_filename[0]['id'])) and df:
+              [Input('session', 'data')])
+def display_link(session):
+    if session and session['corrected']:
         return ({'display':'block'}, {'display':'block'})
-    elif df:
+    elif session:
         return ({'display':'block'}, {'display':'none'})
     else:
         raise PreventUpdate
 
 
 @app.callback(Output('glm-tab', 'style'),
-              [Input('participants','contents'), Input('dfcombined', 'data'), Input('listdir-dgraph', 'columns')])
-def display_link(dgraph_contents, df, dgraph_server_filename):
-    if (dgraph_contents or isfile(dgraph_server_filename[0]['id'])) and df:
+              [Input('session', 'data')])
+def display_link(session):
+    if session and session['corrected']:
         return {'display':'block'}
     else:
         raise PreventUpdate
@@ -1060,67 +1208,12 @@ def show_multiv_summary(df, outDir, activate, method, PERCENT_LOW, PERCENT_HIGH)
         makedirs(outDir, exist_ok= True)
 
     df= pd.DataFrame(df)
-    regions = df.columns.values[1:]
-    subjects = df[df.columns[0]].values
-    L= len(subjects)
-
-    columns= ['Subjects', 'Mahalonobis/IsoForest', 'Outlier']
-    multiv_summary= pd.DataFrame(columns=columns)
-
-    X= df.values
-    meanX= np.mean(X, axis=0)
-    ind= np.where(meanX==0)
-
-    X= np.delete(X, ind, axis=1)
-    meanX= np.delete(meanX, ind)
-
-    if method=='md':
-        PERCENT_LOW= int(PERCENT_LOW) if PERCENT_LOW else 0
-        PERCENT_HIGH = int(PERCENT_HIGH) if PERCENT_HIGH else 80
-        # Mahalanobis distance block =================================
-        # Normalizing to avoid md^2 < 0
-        X = X / np.max(X, axis=0)
-        covX= np.cov(X, rowvar= False)
-        icovX= np.linalg.inv(covX)
-        MD= np.zeros((L,))
-        for i in range(L):
-            x= X[i,: ]
-            MD[i]= mahalanobis(x, meanX, icovX)
-
-        measure= MD
-
-        # ENH could be done according to Chi2 probability, see draft/md_chi2_analysis.py
-
-    elif method=='isf':
-        PERCENT_LOW= int(PERCENT_LOW) if PERCENT_LOW else 3
-        PERCENT_HIGH = int(PERCENT_HIGH) if PERCENT_HIGH else 97
-        # IsolationForest block =================================
-        rng = np.random.RandomState(123456)
-        num_samples = len(subjects)
-        iso_f = IsolationForest(max_samples=num_samples,
-                                contamination=CONTAMIN,
-                                random_state=rng)
-        iso_f.fit(df)
-        pred_scores = iso_f.decision_function(df)
-
-        measure= pred_scores
-
-
-    # Decision block
-    h_thresh= scoreatpercentile(measure, PERCENT_HIGH)
-    l_thresh = scoreatpercentile(measure, PERCENT_LOW)
-    inliers= np.logical_and(measure <= h_thresh, measure >= l_thresh)
-
-    for i in range(L):
-        multiv_summary.loc[i] = [subjects[i], round(measure[i], 3), '' if inliers[i] else 'X']
-        if ~inliers[i]:
-            pass
-            # md.loc[i] = [subjects[i], round(measure[i],3), 'X']
+    multiv_summary= multivariate(df, method, PERCENT_LOW, PERCENT_HIGH)
 
-    filename= pjoin(outDir, 'outliers_multiv.csv')
-    multiv_summary.to_csv(filename, index=False)
+    filename= table_name(pjoin(outDir, 'outliers_multiv'))
+    write_later(multiv_summary, filename)
 
-    return [multiv_summary.to_dict('records'), [{'name': i, 'id': i} for i in columns], True]
+    return [multiv_summary.to_dict('records'), [{'name': i, 'id': i} for i in multiv_summary.columns], True]
 
 
 
@@ -1141,7 +1234,11 @@ def update_graph(df, df_resid, region, extent, outDir):
     df_resid= pd.DataFrame(df_resid)
 
     fig, _, _ = plot_graph_compare(df, df_resid, region, extent)
-    model, summary = display_model(region, outDir)
+    if region in model_regions(outDir):
+        model, summary = display_model(region, outDir)
+    else:
+        # features of a matrix are fitted together, no model is saved for each of them
+        model, summary = {}, f'No saved model for {region}'
 
 
     return (fig, model, summary)
@@ -1164,16 +1261,20 @@ def update_graph(df, region, extent):
 # callback for table_layout
 @app.callback([Output('table-content', 'children'),
                Output('generate table', 'children')],
-               [Input('gen-table','n_clicks'), Input('outDir', 'value')])
-def show_stats_table(activate, outDir):
+               [Input('gen-table','n_clicks'), Input('outDir', 'value'), Input('watch-version', 'data')])
+def show_stats_table(activate, outDir, _):
     # print(button)
     if not activate:
         raise PreventUpdate
 
     outDir= abspath(outDir)
 
-    filename= pjoin(outDir, 'zscores.csv')
-    df_scores= pd.read_csv(filename)
+    run= session_run(outDir)
+    if run:
+        df_scores= score_table(outDir, run)
+    else:
+        filename= table_name(pjoin(outDir, 'zscores'))
+        df_scores= read_table(filename)
     layout= show_table(df_scores)
 
     return (layout, True)
@@ -1211,33 +1312,18 @@ def get_active_cell(selected_cells, view_type, template, subjects, outDir):
         if not template:
             raise PreventUpdate
         # nilearn or freeview rendering
-        fsdir= template.replace('sub-*/', 'sub-{}/'.format(subjects[temp['row']]))
-        if isdir(fsdir):
-            fshome = getenv('FREESURFER_HOME', None)
-            if not fshome:
-                raise EnvironmentError('Please set FREESURFER_HOME and then try again')
-            lut = pjoin(fshome, 'FreeSurferColorLUT.txt')
-            lut = load_lut(lut)
-
-            region= temp['column_id']
-            cmd= render_roi(region, fsdir, lut, outDir, view_type)
+        # validity of freesurfer directories is indexed in outDir on the first click
+        fsdir= lookup(template, subjects[temp['row']], outDir)
+        if fsdir:
+            sources, cmd= roi_sources(temp['column_id'], fsdir, outDir, view_type)
             if view_type=='snapshot':
-                roi_base64=['','','']
-                for i, m in enumerate(['x', 'y', 'z']):
-                    roi_png = pjoin(outDir, f'{region}_{m}.png')
-                    roi_base64[i] = base64.b64encode(open(roi_png, 'rb').read()).decode('ascii')
-
                 msg = ['Execute the following command in a terminal to open images in separate windows:',
                        html.Br(), html.Br(), cmd]
-                return ['data:image/png;base64,{}'.format(roi_base64[0]),
-                        'data:image/png;base64,{}'.format(roi_base64[1]),
-                        'data:image/png;base64,{}'.format(roi_base64[2]),
-                        msg,True,'/zscores#cmd']
-
             else:
                 msg= ['Execute the following command in a terminal to see 3D rendering:',
                       html.Br(), html.Br(), cmd]
-                return [None,None,None,msg,True,'/zscores#cmd']
+
+            return sources+ [msg, True, '/zscores#cmd']
 
 
 
@@ -1245,43 +1331,58 @@ def get_active_cell(selected_cells, view_type, template, subjects, outDir):
 
 
 
+# subjects appended by watch.py are pushed to summary and table
+@app.callback(Output('watch-version', 'data'),
+              [Input('watch-interval', 'n_intervals'), Input('outDir', 'value')],
+              [State('watch-version', 'data')])
+def check_watch(_, outDir, version):
+
+    current= watch_version(abspath(outDir)) if outDir else None
+    if current==version:
+        raise PreventUpdate
+
+    return current
+
+
 # callback for summary_layout
 @app.callback([Output('summary', 'data'),
                Output('summary', 'columns')],
                [Input('subjects', 'data'), Input('outDir', 'value'),
-               Input('extent','value'), Input('group-by', 'value')])
-def update_summary(subjects, outDir, extent, group_by):
+               Input('extent','value'), Input('group-by', 'value'), Input('matrix', 'data'),
+               Input('watch-version', 'data')])
+def update_summary(subjects, outDir, extent, group_by, matrix, version):
 
     # subjects only serve as a control for firing this callback
     if not subjects:
         raise PreventUpdate
 
-    filename = pjoin(outDir, 'zscores.csv')
-    df= pd.read_csv(filename)
-    if group_by=='subjects':
-        dfs = pd.DataFrame(columns=['Subject ID', '# of outliers', 'outliers'])
-        columns = [{'name': i,
-                    'id': i,
-                    'hideable': True,
-                    } for i in dfs.columns]
+    summary= table_name(pjoin(outDir, f'outliers-by-{group_by}'))
+    changed = [item['prop_id'] for item in dash.callback_context.triggered][0]
+    run= None if matrix else session_run(abspath(outDir))
+    if run:
+        # outliers are looked up in the results database, including subjects appended by watch.py
+        dfs= stored_summary(abspath(outDir), run, extent, group_by)
 
-        for i in range(len(df)):
-            outliers=df.columns.values[1:][abs(df.loc[i].values[1:]) > extent]
-            dfs.loc[i]=[df.loc[i][0], len(outliers), '\n'.join([x for x in outliers])]
+    elif 'watch-version' in changed:
+        if not (version and isfile(summary) and watch_extent(outDir)==float(extent)):
+            raise PreventUpdate
+        # updated by watch.py for the new subjects only
+        dfs= read_table(summary, converters={0: str}).fillna('')
 
+    elif matrix:
+        # summarize all features, not just the page in zscores table
+        dfs= outlier_summary(matrix['zscores'], extent, group_by)
     else:
-        dfs = pd.DataFrame(columns=['Regions', '# of outliers', 'outliers'])
-        columns = [{'name': i,
-                    'id': i,
-                    'hideable': True,
-                    } for i in dfs.columns]
-
-        for i,region in enumerate(df.columns[1:]):
-            outliers= df[df.columns[0]].values[abs(df[region]) > extent]
-            dfs.loc[i] = [region, len(outliers), '\n'.join([str(x) for x in outliers])]
-
-    summary= pjoin(outDir, f'outliers-by-{group_by}.csv')
-    dfs.to_csv(summary, index=False)
+        filename = table_name(pjoin(outDir, 'zscores'))
+        df= read_table(filename)
+        dfs= summarize(df, extent, group_by)
+    if 'watch-version' not in changed:
+        # written behind, so changing group-by or extent repeatedly writes the last summary once
+        write_later(dfs, summary)
+    columns = [{'name': i,
+                'id': i,
+                'hideable': True,
+                } for i in dfs.columns]
 
     return [dfs.to_dict('records'), columns]
 
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import argparse
+import traceback
+from os import cpu_count, makedirs
+from os.path import isdir, isfile, isabs, abspath, normpath, dirname, basename, splitext, join as pjoin
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from time import perf_counter
+import pandas as pd
+
+from util import delimiter_dict, read_table, write_table, table_name
+from combine_demography import combine, control_group
+from correct_for_demography import correct
+from model_store import model_files
+from scores import zscores, summarize, multivariate
+from pipeline import content_hash, file_hash
+from results_db import store_run
+
+# columns of a manifest, table is required, demographic correction is done if participants is provided
+MANIFEST_COLUMNS= ['table', 'participants', 'control', 'effect', 'family', 'extent', 'output', 'method', 'delimiter']
+EXTENT= 2
+
+
+def correct_table(df, prefix, outDir, df_demograph, control, effect, family='gaussian', workers=None):
+    '''
+    Combine df with demographics, correct it, and save the tables and models in outDir
+    :param prefix: name of the input table without extension, corrected tables and models are named after it
+    :param family, workers: see correct_for_demography.correct()
+    :return: residuals, combined table, and files written
+    '''
+
+    outPrefix= pjoin(outDir, prefix)
+    exog = '_'.join(effect.split('+'))
+
+    dfcombined, unmatched= combine(df, df_demograph)
+    dfhealthy= control_group(dfcombined, control)
+    df_corrected, df_resid= correct(dfcombined, dfhealthy, df_demograph, effect, outDir, family, workers, control,
+                                    prefix)
+
+    # unmatched subjects are written even if there are none, so that a report of an earlier run does not remain
+    outputs= [table_name(outPrefix+'_combined'), table_name(outPrefix+'_control'), table_name(outPrefix+'_unmatched')]
+    for table, filename in zip([dfcombined, dfhealthy, unmatched], outputs):
+        write_table(table, filename)
+    outputs+= [table_name(f'{outPrefix}_{exog}_corrected'), table_name(f'{outPrefix}_{exog}_residuals')]
+    write_table(df_corrected, outputs[-2])
+    write_table(df_resid, outputs[-1])
+
+    return df_resid, dfcombined, outputs+ [m for m in model_files(outDir, prefix) if isfile(m)]
+
+
+def write_zscores(df, outDir):
+    '''
+    :return: standard scores of df and outDir/zscores table they are saved in
+    '''
+
+    df_scores= zscores(df)
+    filename= table_name(pjoin(outDir, 'zscores'))
+    write_table(df_scores, filename)
+
+    return df_scores, filename
+
+
+def analyze_table(df, prefix, outDir, df_demograph=None, control=None, effect=None, family='gaussian', workers=None):
+    '''
+    Correct df for demographics if df_demograph is provided, and save standard scores in outDir, like app.analyze()
+    :return: residuals (df if not corrected), combined table (df if not corrected), and standard scores
+    '''
+
+    dfcombined= df
+    if df_demograph is not None:
+        df, dfcombined, _= correct_table(df, prefix, outDir, df_demograph, control, effect, family, workers)
+
+    df_scores, _= write_zscores(df, outDir)
+
+    return df, dfcombined, df_scores
+
+
+def _value(job, key, default=None):
+
+    value= job.get(key)
+
+    return default if value is None or pd.isna(value) or value=='' else value
+
+
+def run_job(job):
+    '''
+    Write the outputs of the web application for one manifest row: corrected tables and models, zscores,
+    outliers-by-{subjects,regions}, outliers_multiv, and the results database, see results_db.py,
+    the console output is saved in output/batch.log
+    :return: a row of the run summary
+    '''
+
+    start= perf_counter()
+    outDir= job['output']
+    makedirs(outDir, exist_ok= True)
+    record= {'table': job['table'], 'output': outDir}
+
+    try:
+        with open(pjoin(outDir, 'batch.log'), 'w') as log, redirect_stdout(log):
+            sep= delimiter_dict[_value(job, 'delimiter', 'comma')]
+            df= read_table(job['table'], sep)
+            df_demograph= None
+            participants= _value(job, 'participants')
+            if participants:
+                df_demograph= read_table(participants, sep)
+
+            prefix= splitext(basename(job['table']))[0]
+            # jobs already run in parallel, so their models are fitted in one process
+            family= _value(job, 'family', 'gaussian')
+            df, dfcombined, df_scores= analyze_table(df, prefix, outDir, df_demograph, _value(job, 'control'),
+                                                     _value(job, 'effect'), family, 1)
+            key= content_hash(file_hash(job['table']), file_hash(participants) if participants else None,
+                              _value(job, 'control'), _value(job, 'effect'), family)
+            store_run(outDir, key, df_scores, dfcombined, df if participants else None, prefix)
+
+            extent= float(_value(job, 'extent', EXTENT))
+            for group_by in ['subjects', 'regions']:
+                write_table(summarize(df_scores, extent, group_by), table_name(pjoin(outDir, f'outliers-by-{group_by}')))
+
+            multiv_summary= multivariate(df, _value(job, 'method', 'isf'))
+            write_table(multiv_summary, table_name(pjoin(outDir, 'outliers_multiv')))
+
+        regions= df_scores.columns[1:]
+        record.update({'status': 'done', 'subjects': len(df_scores), 'regions': len(regions),
+                       'outliers': int((abs(df_scores[regions].values.astype(float))>extent).sum()),
+                       'multivariate outliers': int((multiv_summary['Outlier']=='X').sum())})
+
+    except Exception:
+        record.update({'status': 'failed', 'error': traceback.format_exc().strip().split('\n')[-1]})
+
+    record['seconds']= round(perf_counter()- start, 3)
+
+    return record
+
+
+def read_manifest(manifest, outDir):
+    '''
+    :return: list of jobs, paths are relative to the manifest, output defaults to outDir/{row}-{table name},
+        outputs of jobs must be different
+    '''
+
+    df= read_table(manifest)
+    unknown= [c for c in df.columns if c not in MANIFEST_COLUMNS]
+    if 'table' not in df.columns or unknown:
+        raise ValueError(f'manifest must have table column and optionally {MANIFEST_COLUMNS[1:]}, found {unknown}')
+
+    root= dirname(abspath(manifest))
+    resolve= lambda path: path if isabs(path) else abspath(pjoin(root, path))
+
+    jobs= []
+    for i, job in enumerate(df.to_dict('records')):
+        job['table']= resolve(job['table'])
+        if _value(job, 'participants'):
+            job['participants']= resolve(job['participants'])
+            if not (_value(job, 'control') and _value(job, 'effect')):
+                raise ValueError(f'row {i} of {manifest} has participants but no control or effect')
+        output= _value(job, 'output')
+        job['output']= resolve(output) if output else pjoin(outDir, f'{i}-{splitext(basename(job["table"]))[0]}')
+        # jobs run at the same time, they would overwrite zscores and summaries of each other in the same output
+        same= [j for j, other in enumerate(jobs) if normpath(other['output'])==normpath(job['output'])]
+        if same:
+            raise ValueError(f'rows {same[0]} and {i} of {manifest} have the same output {job["output"]}')
+        jobs.append(job)
+
+    return jobs
+
+
+def run_batch(jobs, ncpu=None):
+    '''
+    :return: run summary with one row per job
+    '''
+
+    ncpu= min(ncpu or cpu_count(), len(jobs)) or 1
+    with ProcessPoolExecutor(max_workers=ncpu) as executor:
+        records= list(executor.map(run_job, jobs))
+
+    summary= pd.DataFrame(records)
+    # counts of failed jobs are missing
+    counts= [c for c in ['subjects', 'regions', 'outliers', 'multivariate outliers'] if c in summary.columns]
+    summary[counts]= summary[counts].astype('Int64')
+
+    return summary
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Run the outlier analysis of the web application without a browser '
+                                                'for several tables, cohorts, and demographic models in parallel',
+                                    formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-m', '--manifest', required=True,
+                        help='a csv file with one job per row and the following columns:\n'
+                             'table: subjects x regions table e.g. asegstats.csv, required\n'
+                             'participants: demographic info, residuals are analyzed if provided\n'
+                             'control: control group expression e.g. group==1, required with participants\n'
+                             'effect: demographic effect e.g. age+sex, required with participants\n'
+                             'family: GLM family of correct_for_demography.py e.g. gamma:log, default: gaussian\n'
+                             f'extent: acceptable zscore, default: {EXTENT}\n'
+                             'output: output directory, one per row, default: --output/{row}-{table name}\n'
+                             'method: multivariate method, isf or md, default: isf\n'
+                             'delimiter: comma, tab, semicolon, or space, default: comma\n'
+                             'relative paths are relative to the manifest')
+    parser.add_argument('-o', '--output', required=True, help='a directory where the run summary and default job '
+                                                              'outputs are saved')
+    parser.add_argument('-n', '--ncpu', type=int, default=None,
+                        help='number of jobs run at a time, default: number of cores')
+
+    args= parser.parse_args()
+    outDir= abspath(args.output)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
+
+    jobs= read_manifest(abspath(args.manifest), outDir)
+    summary= run_batch(jobs, args.ncpu)
+
+    filename= table_name(pjoin(outDir, 'batch_summary'))
+    write_table(summary, filename)
+    print(summary.to_string(index=False))
+    print('\nRun summary is saved in', filename)
+
+    # non-zero exit status for schedulers if any job failed
+    exit(int((summary['status']!='done').any()))
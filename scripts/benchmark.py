@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import platform
+from datetime import datetime
+from glob import glob
+from os import cpu_count, makedirs, devnull, remove
+from os.path import isdir, isfile, abspath, dirname, join as pjoin
+from shutil import rmtree
+from subprocess import check_output, DEVNULL
+from tempfile import mkdtemp
+from time import perf_counter
+from contextlib import redirect_stdout
+
+from synthetic_cohort import make_cohort
+from stats2table import stats2table
+from scores import zscores, summarize, multivariate
+from combine_demography import combine, control_group
+from correct_for_demography import correct
+from model_store import model_files
+from pipeline import CACHE
+from util import read_table
+
+SCRIPTDIR= dirname(abspath(__file__))
+STAGES= ['extraction', 'join', 'glm', 'zscores', 'summaries', 'multivariate', 'roi']
+
+
+def timeit(func, repeat=1, setup=None):
+    '''
+    :param setup: called before each run, not timed
+    :return: (minimum wall clock time of repeat runs in seconds, output of the last run)
+    '''
+
+    times= []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start= perf_counter()
+        with open(devnull, 'w') as f, redirect_stdout(f):
+            result= func()
+        times.append(perf_counter()- start)
+
+    return min(times), result
+
+
+def benchmark_size(workDir, num_subjects, num_regions, stages, repeat=1, ncpu=None):
+
+    cohortDir= pjoin(workDir, f'{num_subjects}x{num_regions}')
+    makedirs(cohortDir, exist_ok= True)
+    template= make_cohort(cohortDir, num_subjects, num_regions)
+    outDir= pjoin(cohortDir, 'out')
+    makedirs(outDir, exist_ok= True)
+
+    # tables are passed between stages in memory
+    tables= {'regions': read_table(pjoin(cohortDir, 'regions.csv')),
+             'participants': read_table(pjoin(cohortDir, 'participants.csv'))}
+
+    def extraction():
+        stats2table(None, template, outDir, ncpu=ncpu)
+
+    def join():
+        tables['combined'], _= combine(tables['regions'], tables['participants'])
+        tables['control']= control_group(tables['combined'], 'group==1')
+
+    def glm():
+        _, tables['residuals']= correct(tables['combined'], tables['control'], tables['participants'], 'age', outDir)
+
+    def clear_models():
+        # models saved by an earlier run would be restored by correct() instead of fitted
+        for filename in model_files(outDir)+ glob(pjoin(outDir, CACHE, 'models-*')):
+            if isfile(filename):
+                remove(filename)
+
+    def roi():
+        from view_roi import load_lut, render_roi
+        lut= load_lut(pjoin(cohortDir, 'FreeSurferColorLUT.txt'))
+        render_roi('Region-1', template.replace('*', f'{1:05d}'), lut, outDir, 'snapshot')
+
+    funcs= {'extraction': [('extraction', extraction)],
+            'join': [('join', join)],
+            'glm': [('glm', glm), ('glm-cached', glm)],
+            'zscores': [('zscores', lambda: zscores(tables['residuals']))],
+            'summaries': [(f'summaries-{g}', lambda g=g: summarize(zscores(tables['residuals']), 2, g))
+                          for g in ['subjects', 'regions']],
+            'multivariate': [(f'multivariate-{m}', lambda m=m: multivariate(tables['residuals'], m))
+                             for m in ['md', 'isf']],
+            'roi': [('roi', roi)]}
+
+    setups= {'glm': clear_models}
+
+    records= []
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        if stage in ['zscores', 'summaries', 'multivariate'] and 'residuals' not in tables:
+            # prerequisites of stages that are not timed
+            timeit(join)
+            timeit(glm)
+        for name, func in funcs[stage]:
+            record= {'stage': name, 'subjects': num_subjects, 'regions': num_regions, 'repeat': repeat}
+            try:
+                record['seconds'], _= timeit(func, repeat, setups.get(name))
+            except Exception as e:
+                record['error']= repr(e)
+            print(record)
+            records.append(record)
+
+    return records
+
+
+def git_commit():
+
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'], cwd=SCRIPTDIR, stderr=DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline):
+    '''
+    Print the ratio of baseline to current timings, > 1 means faster than baseline
+    '''
+
+    key= lambda r: (r['stage'], r['subjects'], r['regions'])
+    old= {key(r): r for r in baseline['results'] if 'seconds' in r}
+
+    print(f'\nCompared against {baseline.get("commit")}')
+    print(f'{"stage":<24}{"size":>14}{"baseline (s)":>14}{"current (s)":>14}{"speedup":>10}')
+    for r in results['results']:
+        if 'seconds' not in r or key(r) not in old:
+            continue
+        t= old[key(r)]['seconds']
+        print(f'{r["stage"]:<24}{str(r["subjects"])+"x"+str(r["regions"]):>14}{t:>14.4f}{r["seconds"]:>14.4f}'
+              f'{t/r["seconds"]:>10.2f}')
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Time each stage of the outlier pipeline on synthetic cohorts '
+                                                'of several sizes')
+
+    parser.add_argument('-s', '--sizes', default='100x50,1000x100',
+                        help='comma separated list of {subjects}x{regions}, default: %(default)s')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated list of stages to time, default: %(default)s')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of runs of each stage, minimum time is reported, default: %(default)s')
+    parser.add_argument('-n', '--ncpu', type=int, default=None,
+                        help='number of processes for stats extraction, default: number of cores')
+    parser.add_argument('-o', '--output', required=True, help='a json file where results are saved')
+    parser.add_argument('-b', '--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('-w', '--workdir', help='a directory for synthetic cohorts, a temporary one is used and '
+                                                'removed if not provided')
+
+    args= parser.parse_args()
+
+    workDir= abspath(args.workdir) if args.workdir else mkdtemp()
+    if not isdir(workDir):
+        makedirs(workDir, exist_ok= True)
+
+    stages= args.stages.split(',')
+    records= []
+    for size in args.sizes.split(','):
+        num_subjects, num_regions= [int(x) for x in size.split('x')]
+        records+= benchmark_size(workDir, num_subjects, num_regions, stages, args.repeat, args.ncpu)
+
+    results= {'commit': git_commit(),
+              'date': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpu_count': cpu_count(),
+              'results': records}
+
+    with open(abspath(args.output), 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nResults saved in', abspath(args.output))
+
+    if args.baseline:
+        with open(abspath(args.baseline)) as f:
+            compare(results, json.load(f))
+
+    if not args.workdir:
+        rmtree(workDir)
@@ -5,7 +5,49 @@ from os.path import isfile, isdir, abspath, dirname, basename, join as pjoin, sp
 from os import makedirs, remove
 import pandas as pd
 import numpy as np
-from util import delimiter_dict
+from util import delimiter_dict, read_table, write_table, table_name, subject_key
+
+
+def combine(df, df_demograph):
+    '''
+    Join region based statistics and demographic info on subject ids
+    :param df: subjects x regions table, first column is subject ids
+    :param df_demograph: subjects x demographics table, first column is subject ids
+    :return: table of matched subjects in the order of df_demograph with regions followed by demographics,
+        and table of unmatched subject ids with the table they are missing from
+    '''
+
+    id_col_hdr= df.columns[0]
+    demographs= df_demograph.columns[1: ]
+
+    # ids are matched by subject_key() so that 1, '1', and '00001' read from different formats do not diverge
+    key= [subject_key(id) for id in df[id_col_hdr].tolist()]
+    dkey= [subject_key(id) for id in df_demograph.iloc[:,0].tolist()]
+
+    regions= df.drop(columns=[c for c in demographs if c in df.columns])
+    dfcomb= df_demograph[demographs].assign(_key=dkey) \
+        .merge(regions.assign(_key=key), on='_key', how='inner', sort=False)
+    dfcomb= dfcomb[list(regions.columns)+ list(demographs)]
+    if not len(dfcomb):
+        raise ValueError(f'no subject of the table e.g. {key[:3]} is in participants e.g. {dkey[:3]}, '
+                         'subject ids must be the same in both')
+
+    keys, dkeys= set(key), set(dkey)
+    unmatched= pd.concat([
+        pd.DataFrame({'subject': df[id_col_hdr][[k not in dkeys for k in key]].values, 'missing from': 'participants'}),
+        pd.DataFrame({'subject': df_demograph.iloc[:,0][[k not in keys for k in dkey]].values, 'missing from': 'input'})],
+        ignore_index=True)
+
+    return dfcomb, unmatched
+
+
+def control_group(dfcomb, control):
+    '''
+    :param control: a mathematical expression to filter healthy control subjects e.g. age>40 and age<50
+    :return: combine() output of the control group
+    '''
+
+    return dfcomb.query(control)
 
 
 if __name__ == '__main__':
@@ -38,30 +80,20 @@ if __name__ == '__main__':
     if not isdir(outDir):
         makedirs(outDir, exist_ok= True)
 
-    df= pd.read_csv(abspath(args.input), sep=delimiter_dict[args.delimiter])
-    df_demograph= pd.read_csv(abspath(args.participants), sep=delimiter_dict[args.delimiter])
-    dfcomb= pd.DataFrame(columns=df.columns)
-
-    ids= df_demograph.iloc[:,0].values
-    demographs= df_demograph.columns[1: ]
-
-    # not all ids from participants can be in input, so the following complicated logic
-    i=0
-    for id in ids:
-         dfcomb.loc[i]= df.loc[np.where(id==ids)[0][0]]
-         i+=1
-
-    for attr in demographs:
-        temp= df_demograph[attr]
-        dfcomb[attr]= temp.astype(temp.dtype)
-
-    id_col_hdr= df.columns[0]
-    dfcomb[id_col_hdr]= dfcomb[id_col_hdr].astype(df[id_col_hdr].dtype)
+    df= read_table(abspath(args.input), delimiter_dict[args.delimiter])
+    df_demograph= read_table(abspath(args.participants), delimiter_dict[args.delimiter])
+    dfcomb, unmatched= combine(df, df_demograph)
 
     prefix= splitext(basename(args.input))[0]
-    dfcomb.to_csv(pjoin(outDir, prefix+'_combined.csv'), index=False)
+    write_table(dfcomb, table_name(pjoin(outDir, prefix+'_combined')))
+
+    # written even if there are none, so that a report of an earlier run does not remain
+    filename= table_name(pjoin(outDir, prefix+'_unmatched'))
+    write_table(unmatched, filename)
+    for missing, count in unmatched['missing from'].value_counts().items():
+        print(f'{count} subjects are missing from {missing}, see {filename}')
 
 
     # filter the controls
-    dfhealthy= dfcomb.query(args.control)
-    dfhealthy.to_csv(pjoin(outDir, prefix+'_control.csv'), index=False)
+    dfhealthy= control_group(dfcomb, args.control)
+    write_table(dfhealthy, table_name(pjoin(outDir, prefix+'_control')))
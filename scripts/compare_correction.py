@@ -20,7 +20,9 @@ import numpy as np
 import argparse
 import logging
 
-from util import delimiter_dict
+from util import delimiter_dict, read_table, write_table, table_name
+from correct_for_demography import model_results
+from model_store import model_regions
 from verify_ports import get_ports
 compare_port= get_ports('compare_port')
 
@@ -152,7 +154,7 @@ def display_model(region):
 
     print(f'\nDisplaying GLM fitting on {region}')
 
-    res = sm.load_pickle(pjoin(outDir, f'.{region}.pkl'))
+    res = model_results(outDir, region)
 
     fig = make_subplots(
         rows=2, cols=2,
@@ -278,14 +280,14 @@ if __name__ == '__main__':
     if not isdir(outDir):
         makedirs(outDir, exist_ok= True)
 
-    df = pd.read_csv(abspath(args.input),sep=delimiter_dict[args.delimiter])
-    df_demograph = pd.read_csv(abspath(args.participants))
+    df = read_table(abspath(args.input), delimiter_dict[args.delimiter])
+    df_demograph = read_table(abspath(args.participants))
     demographs = df_demograph.columns[1:]
 
     regions = [var for var in df.columns.values[1:] if var not in demographs]
     subjects = df[df.columns[0]].values
 
-    df_resid= pd.read_csv(abspath(args.corrected))
+    df_resid= read_table(abspath(args.corrected))
 
     # generate all figures
     df_inliers= df.copy()
@@ -299,14 +301,14 @@ if __name__ == '__main__':
         df_inliers[column_name] = zscores
 
 
-    df_inliers.to_csv(pjoin(outDir, 'outliers.csv'), index=False)
+    write_table(df_inliers, table_name(pjoin(outDir, 'outliers')))
 
     app.layout = html.Div([
 
         html.Div([
             dcc.Dropdown(
                 id='region',
-                options=[{'label': i, 'value': i} for i in regions if isfile(pjoin(outDir, f'.{i}.pkl'))],
+                options=[{'label': i, 'value': i} for i in regions if i in model_regions(outDir)],
                 value=regions[0]
             )
         ],
@@ -2,10 +2,308 @@
 
 import argparse
 from os.path import isfile, isdir, abspath, dirname, basename, join as pjoin, splitext
-from os import makedirs
+from os import makedirs, cpu_count
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import numpy as np
+import patsy
 import statsmodels.api as sm
-import statsmodels.formula.api as smf
+from statsmodels.genmod.generalized_linear_model import GLMResults, GLMResultsWrapper
+from util import read_table, write_table, table_name
+from model_store import save_models, find_models, cached_models, STATS
+from pipeline import content_hash
+
+# --family choices, links other than the default one are given as family:link e.g. gamma:identity
+FAMILIES= {'gaussian': sm.families.Gaussian, 'gamma': sm.families.Gamma, 'inverse_gaussian': sm.families.InverseGaussian,
+           'poisson': sm.families.Poisson}
+LINKS= {'identity': sm.families.links.Identity, 'log': sm.families.links.Log, 'inverse': sm.families.links.InversePower,
+        'sqrt': sm.families.links.Sqrt}
+DEFAULT_LINK= {'gaussian': 'identity', 'gamma': 'log', 'inverse_gaussian': 'log', 'poisson': 'log'}
+
+
+def design(effect, df):
+    '''
+    :param effect: right hand side of the model e.g. age+sex
+    :return: design matrix of effect for rows of df without missing values, and its design info for other subjects
+    '''
+
+    X= patsy.dmatrix(effect, df, return_type='dataframe')
+
+    return X, X.design_info
+
+
+def design_matrix(design_info, df):
+    '''
+    :return: design matrix of df for a design() of the control group, rows with missing values are predicted as nan
+    '''
+
+    return np.asarray(patsy.build_design_matrices([design_info], df, NA_action=patsy.NAAction(NA_types=[]))[0])
+
+
+def least_squares(X, Y):
+    '''
+    Fit all columns of Y on the same design X with one factorization, the closed form of Gaussian GLM with identity link
+    :param X: subjects x terms design matrix
+    :param Y: subjects x regions array without missing values
+    :return: terms x regions coefficients, terms x terms normalized covariance shared by all regions,
+        and scale (residual variance) of each region
+    '''
+
+    pinv= np.linalg.pinv(X)
+    B= pinv @ Y
+    df_resid= X.shape[0]- np.linalg.matrix_rank(X)
+    scale= ((Y- X @ B)**2).sum(axis=0)/df_resid
+
+    return B, pinv @ pinv.T, scale
+
+
+def glm_results(y, X, family, params, normalized_cov, scale, iterations=0):
+    '''
+    :return: statsmodels GLM results of a fit without fitting again, the same as those of smf.glm().fit()
+    '''
+
+    model= sm.GLM(y, X, family=family)
+    res= GLMResults(model, params, normalized_cov, scale)
+    res.method= 'IRLS' if iterations else 'lstsq'
+    res.fit_history= {'iteration': int(iterations)}
+    res.converged= True
+
+    return GLMResultsWrapper(res)
+
+
+def glm_family(family):
+    '''
+    :param family: name of a family in FAMILIES optionally followed by :link e.g. gamma or gamma:identity
+    :return: statsmodels family
+    '''
+
+    name, _, link= family.partition(':')
+    if name not in FAMILIES or (link and link not in LINKS):
+        raise ValueError(f'family must be one of {list(FAMILIES)} optionally followed by :{"/:".join(LINKS)}, '
+                         f'found {family}')
+
+    return FAMILIES[name](LINKS[link or DEFAULT_LINK[name]]())
+
+
+def _fit_region(y, X, family):
+
+    rows= ~np.isnan(y)
+    res= sm.GLM(y[rows], X[rows], family=glm_family(family)).fit()
+    # summary is not generated here, _compare_layout.display_model() does it for the region being viewed
+
+    return res.params, res.normalized_cov_params, res.scale, res.fit_history['iteration']
+
+
+def fit_regions(X, Y, family, workers=None):
+    '''
+    Fit a GLM of each region in its own process, for families that cannot share one least_squares() solve
+    :param workers: number of processes, default: number of cores
+    :return: terms x regions coefficients, regions x terms x terms normalized covariance, scale and iterations
+        of each region
+    '''
+
+    n= Y.shape[1]
+    workers= min(workers or cpu_count(), n) or 1
+    args= [list(Y.T), [X.values]*n, [family]*n]
+    if workers==1:
+        fits= list(map(_fit_region, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fits= list(executor.map(_fit_region, *args, chunksize=max(1, n//(4*workers))))
+
+    params, cov, scale, iterations= zip(*fits)
+
+    return np.array(params).T.reshape(X.shape[1], n), np.array(cov), np.array(scale), np.array(iterations)
+
+
+def fit_least_squares(X, Y):
+    '''
+    Fit Gaussian models of all regions by least_squares(), regions having missing values are fitted on their own rows
+    :return: same as fit_regions()
+    '''
+
+    p, n= X.shape[1], Y.shape[1]
+    B= np.zeros((p, n))
+    cov= np.zeros((n, p, p))
+    scale= np.zeros(n)
+    missing= np.isnan(Y)
+    complete= ~missing.any(axis=0)
+    B[:, complete], cov[complete], scale[complete]= least_squares(X.values, Y[:, complete])
+    for j in np.flatnonzero(~complete):
+        rows= ~missing[:, j]
+        B[:, j:j+1], cov[j], scale[j:j+1]= least_squares(X.values[rows], Y[rows, j:j+1])
+
+    return B, cov, scale, np.zeros(n)
+
+
+def model_key(frame, effect, family, control=None):
+    '''
+    :param frame: demographics and regions of the control group
+    :return: content_hash() of the control subjects' data, control expression, effect, and family models are fitted on
+    '''
+
+    data= pd.util.hash_pandas_object(frame, index=False).values.tobytes()
+
+    return content_hash(data, '\n'.join(frame.columns), control, effect, family)
+
+
+def save_fit(outDir, prefix, regions, X, frame, Y, fit, family, effect, key=None):
+    '''
+    Save models of all regions in the model store of prefix in outDir, see model_store.py
+    :param X: design of the control group, see design()
+    :param frame: demographics of the control group the design is built from
+    :param Y: control subjects x regions values
+    :param fit: fit_least_squares() or fit_regions() output
+    :param key: model_key() the models are cached for
+    '''
+
+    B, cov, scale, iterations= fit
+    fam= glm_family(family)
+    mu= fam.link.inverse(X.values @ B)
+
+    # same as llf, deviance, and pearson_chi2 of statsmodels GLM results
+    stats= np.zeros((len(regions), len(STATS)))
+    for j in range(len(regions)):
+        rows= ~np.isnan(Y[:, j])
+        y, m= Y[rows, j], mu[rows, j]
+        llf_scale= ((y- m)**2).mean() if isinstance(fam, sm.families.Gaussian) and \
+            isinstance(fam.link, sm.families.links.Identity) else scale[j]
+        stats[j]= [scale[j], fam.loglike(y, m, scale=llf_scale), fam.deviance(y, m), ((y- m)**2/fam.variance(m)).sum(),
+                   iterations[j]]
+
+    info= {'regions': regions, 'terms': list(X.columns), 'family': family, 'effect': effect,
+           'control': frame.to_dict('list')}
+    if key:
+        info['key']= key
+    save_models(outDir, prefix, info, B, cov, stats, Y- mu)
+
+
+def control_design(models):
+    '''
+    :param models: model_store.load_models() output
+    :return: design() of the control group the models were fitted on, built once for the loaded store
+    '''
+
+    if 'design' not in models:
+        models['design']= design(models['effect'], pd.DataFrame(models['control']))
+
+    return models['design']
+
+
+def predict(models, df):
+    '''
+    :return: subjects x regions predictions of all models for df
+    '''
+
+    design_info= control_design(models)[1]
+
+    return glm_family(models['family']).link.inverse(design_matrix(design_info, df) @ models['params'].T)
+
+
+def control_scores(models):
+    '''
+    :param models: model_store.load_models() output
+    :return: mean and standard deviation of residuals=(predicted-given)^2 of the control group in each region,
+        computed once for the loaded store
+    '''
+
+    if 'control_scores' not in models:
+        resid= np.square(models['resid'])
+        models['control_scores']= np.nanmean(resid, axis=1), np.nanstd(resid, axis=1)
+
+    return models['control_scores']
+
+
+def model_results(outDir, region):
+    '''
+    Reconstruct statsmodels GLM results of a region from the model store of outDir saved last having it,
+    for its summary and diagnostics
+    '''
+
+    models= find_models(outDir, region)
+    j= models['regions'].index(region)
+    X= control_design(models)[0]
+    family= glm_family(models['family'])
+    params= np.array(models['params'][j])
+
+    resid= models['resid'][j]
+    rows= ~np.isnan(resid)
+    mu= family.link.inverse(X.values[rows] @ params)
+    y= pd.Series(resid[rows]+ mu, index=X.index[rows], name=f'Q("{region}")')
+
+    return glm_results(y, X[rows], family, pd.Series(params, index=X.columns), np.array(models['cov'][j]),
+                       models['stats']['scale'][j], models['stats']['iterations'][j])
+
+
+def correct(df, dfhealthy, df_demograph, effect, outDir=None, family='gaussian', workers=None, control=None,
+            prefix=None):
+    '''
+    Fit a GLM of each region on effect in the control group and predict the region for all subjects,
+    Gaussian models of all regions are fitted at once by fit_least_squares() on the design of the control group,
+    models of other families by fit_regions(). Models saved in outDir for the same model_key() are used
+    without fitting again.
+    :param df: region based statistics and demographic info, see combine_demography.combine()
+    :param dfhealthy: df of the control group, see combine_demography.control_group()
+    :param df_demograph: demographic info, demographic variable names are learnt from it
+    :param outDir: fitted models are saved in outDir/.{prefix}.models.npy if provided, see save_fit()
+    :param family: see glm_family()
+    :param workers: number of processes for fit_regions()
+    :param control: control expression the control group was selected by, see model_key()
+    :param prefix: name of the table e.g. asegstats, models of different tables are saved side by side
+    :return: corrected (predicted) table and residuals=(predicted-given)^2 table, without demographic info
+    '''
+
+    df_corrected= df.copy()
+    demographs= df_demograph.columns[1: ]
+
+    regions= []
+    for var in df.columns[1:]:
+        if var not in demographs:
+            regions.append(var)
+        else:
+            df_corrected.drop(var, axis=1, inplace= True)
+
+    df_resid= df_corrected.copy()
+
+    # no model can be fitted without control subjects or regions, fail before fitting rather than in it
+    selected= f' selected by {control}' if control else ''
+    if not len(dfhealthy):
+        raise ValueError(f'no subject is in the control group{selected}, check the control expression '
+                         'and that subject ids of the table are in participants')
+
+    # regions that are all zero in the control group are left as they are
+    regions= [region for region in regions if dfhealthy[region].values.any()]
+    if not regions:
+        raise ValueError(f'every region is zero in the control group{selected}, no region can be modeled')
+    frame= dfhealthy[list(demographs)+ regions]
+    key= model_key(frame, effect, family, control) if outDir else None
+    models= cached_models(outDir, prefix, key) if outDir else None
+
+    if models:
+        print('models of the control group are cached, skipping fitting')
+        predicted= predict(models, df)
+    else:
+        X, design_info= design(effect, dfhealthy)
+        if not len(X):
+            raise ValueError(f'no subject of the control group{selected} has values of every variable in {effect}')
+        Y= dfhealthy.loc[X.index, regions].values.astype(float)
+        link= glm_family(family).link
+
+        if family.partition(':')[0]=='gaussian' and isinstance(link, sm.families.links.Identity):
+            fit= fit_least_squares(X, Y)
+        else:
+            fit= fit_regions(X, Y, family, workers)
+        B= fit[0]
+
+        print(pd.DataFrame(B.T, index=regions, columns=X.columns))
+        if outDir:
+            save_fit(outDir, prefix, regions, X, frame.loc[X.index, demographs], Y, fit, family, effect, key)
+        predicted= link.inverse(design_matrix(design_info, df) @ B)
+
+    df_corrected[regions]= predicted
+    df_resid[regions]= (df_corrected[regions]- df[regions])**2
+
+    return df_corrected, df_resid
 
 
 if __name__ == '__main__':
@@ -27,6 +325,12 @@ if __name__ == '__main__':
                              'age\n'
                              'age+eduyears\n'
                              'age+race\n')
+    parser.add_argument('-f', '--family', default='gaussian',
+                        help=f'GLM family {list(FAMILIES)}, optionally followed by :link {list(LINKS)} e.g. gamma:log '
+                             'for skewed measures, gaussian models of all regions are fitted at once, '
+                             'others are fitted region by region in --workers processes, default: %(default)s')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of processes fitting non-gaussian models, default: number of cores')
 
 
     args= parser.parse_args()
@@ -34,46 +338,14 @@ if __name__ == '__main__':
     if not isdir(outDir):
         makedirs(outDir, exist_ok= True)
 
-    df= pd.read_csv(abspath(args.input))
-    df_demograph= pd.read_csv(abspath(args.participants))
-    dfhealthy= pd.read_csv(abspath(args.control))
-    df_corrected= df.copy()
-
-    ids= df_demograph.iloc[:,0].values
-    demographs= df_demograph.columns[1: ]
+    df= read_table(abspath(args.input))
+    df_demograph= read_table(abspath(args.participants))
+    dfhealthy= read_table(abspath(args.control))
+    table= splitext(basename(args.input))[0].replace('_combined','')
+    df_corrected, df_resid= correct(df, dfhealthy, df_demograph, args.effect, outDir, args.family, args.workers,
+                                    prefix=table)
 
-    regions= []
-    for var in df.columns[1:]:
-        if var not in demographs:
-            regions.append(var)
-        else:
-            df_corrected.drop(var, axis=1, inplace= True)
-
-    df_resid= df_corrected.copy()
-
-    # model fitting and prediction
     exog= args.effect.split('+')
-    for region in regions:
-        print(region)
-
-        formula = f'Q("{region}")~{args.effect}'
-        endog_exog= [region]+ exog
-
-
-        if dfhealthy[region].values.any():
-            res = smf.glm(formula=formula, data=dfhealthy[endog_exog], family=sm.families.Gaussian()).fit()
-            res.save(pjoin(outDir, f'.{region}.pkl'))
-        else:
-            continue
-
-        print(res.summary())
-
-        df_corrected[region]= res.predict(df[endog_exog])
-
-        df_resid[region] = (df_corrected[region] - df[region]) ** 2
-
-        print('\n')
-
-    prefix= splitext(basename(args.input))[0].replace('_combined','')+ '_'+ '_'.join(exog)
-    df_corrected.to_csv(pjoin(outDir, prefix + '_corrected.csv'), index=False)
-    df_resid.to_csv(pjoin(outDir, prefix + '_residuals.csv'), index=False)
+    prefix= table+ '_'+ '_'.join(exog)
+    write_table(df_corrected, table_name(pjoin(outDir, prefix + '_corrected')))
+    write_table(df_resid, table_name(pjoin(outDir, prefix + '_residuals')))
@@ -3,10 +3,13 @@
 import argparse
 from os.path import isfile, isdir, abspath, dirname, basename, join as pjoin, splitext
 from os import makedirs, remove
-from time import sleep
-SCRIPTDIR=dirname(abspath(__file__))
-from subprocess import check_call, Popen
 from verify_ports import get_ports
+from pipeline import run_stage
+from legacy_server import load_dataset, serve
+from util import delimiter_dict, read_table, write_table, table_name
+from combine_demography import combine, control_group
+from correct_for_demography import correct
+from model_store import model_files
 
 
 if __name__ == '__main__':
@@ -42,6 +45,11 @@ In total, its purpose is to calculate outliers incorporating demographics and di
                              'age\n'
                              'age+eduyears\n'
                              'age+race\n')
+    parser.add_argument('-f', '--family', default='gaussian',
+                        help='GLM family, optionally followed by :link e.g. gamma:log, see correct_for_demography.py, '
+                             'default: %(default)s')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of processes fitting non-gaussian models, default: number of cores')
     parser.add_argument('--extent', type=float, default=2, help='values beyond mean \u00B1 e*STD are outliers, if e<5; '
                         'values beyond e\'th percentile are outliers, if e>70; default %(default)s')
     parser.add_argument('-t', '--template', required=False,
@@ -52,48 +60,43 @@ In total, its purpose is to calculate outliers incorporating demographics and di
 
     args = parser.parse_args()
 
-    get_ports()
+    port= get_ports('summary_port')
 
     # python scripts\combine_demography.py -i asegstats.csv -o dem_corrected/ -p participants.csv -c "checkin_bin==3"
-    exe= pjoin(SCRIPTDIR, 'combine_demography.py')
-    cmd= f'python {exe} -i {args.input} -o {args.output} -p {args.participants} -c "{args.control}"'
-    check_call(cmd, shell=True)
-
-
     # python scripts\correct_for_demography.py -i asegstats_combined.csv -c asegstats_control.csv -e age
     # -p participants.csv -o dem_corrected/
-    prefix= basename(args.input).split('.csv')[0]
-    outPrefix= pjoin(args.output, prefix)
-    exe= pjoin(SCRIPTDIR, 'correct_for_demography.py')
-    cmd= f'python {exe} -i {outPrefix}_combined.csv -c {outPrefix}_control.csv -p {args.participants} -e "{args.effect}" ' \
-         f'-o {args.output}'
-    check_call(cmd, shell=True)
+    # are run in this process
+    outDir= abspath(args.output)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
 
+    prefix= splitext(basename(args.input))[0]
+    outPrefix= pjoin(outDir, prefix)
     exog = '_'.join(args.effect.split('+'))
-    residuals= f'{outPrefix}_{exog}_residuals.csv'
-
-
-    # python scripts\generate-summary.py -i asegstats_residuals.csv -o dem_corrected/
-    exe= pjoin(SCRIPTDIR, 'generate-summary.py')
-    cmd= f'python {exe} -i {residuals} -e {args.extent} -o {args.output} -t {args.template}'
-    Popen(cmd, shell=True)
-
-
-    # force the pipeline to wait because outlier.csv is required in the subsequent step
-    # if not put to sleep, then it would progress to compare_correction right away
-    # and raise EnvironmentError for compare_port
-    sleep_time= 60
-    print(f'\nWaiting {sleep_time} seconds for previous job to complete ...\n')
-    sleep(sleep_time)
-    while 1:
-        if isfile(pjoin(args.output,'outliers.csv')):
-            break
-
-
-    # python scripts\compare_correction.py -i asegstats_combined.csv -c asegstats_age_residuals.csv
-    # -p participants.csv -o dem_corrected/
-    exe= pjoin(SCRIPTDIR, 'compare_correction.py')
-    cmd= f'python {exe} -i {outPrefix}_combined.csv -c {residuals} -p {args.participants} ' \
-         f'-e {args.extent} -o {args.output}'
-    Popen(cmd, shell=True)
-
+    residuals= table_name(f'{outPrefix}_{exog}_residuals')
+    outputs= [table_name(outPrefix+'_combined'), table_name(outPrefix+'_control'),
+              table_name(f'{outPrefix}_{exog}_corrected'), residuals, table_name(outPrefix+'_unmatched')]
+    # the stage is run again if its models are removed, score_subjects.py and watch.py need them
+    models= model_files(outDir, prefix)
+
+    def correction():
+        df= read_table(abspath(args.input), delimiter_dict[args.delimiter])
+        df_demograph= read_table(abspath(args.participants), delimiter_dict[args.delimiter])
+        dfcomb, unmatched= combine(df, df_demograph)
+        dfhealthy= control_group(dfcomb, args.control)
+        df_corrected, df_resid= correct(dfcomb, dfhealthy, df_demograph, args.effect, outDir, args.family,
+                                        args.workers, args.control, prefix)
+
+        # unmatched subjects are written even if there are none, so that a report of an earlier run does not remain
+        for df, filename in zip([dfcomb, dfhealthy, df_corrected, df_resid, unmatched], outputs):
+            write_table(df, filename)
+
+    # correction is not run again if neither inputs nor parameters have changed
+    run_stage('correction', correction, [abspath(args.input), abspath(args.participants)], outputs+ models,
+              {'control': args.control, 'effect': args.effect, 'family': args.family, 'delimiter': args.delimiter}, outDir)
+
+
+    # summary of generate-summary.py on residuals and comparison of compare_correction.py against combined table
+    # are served by one process on one port
+    data= load_dataset(outputs[0], outDir, corrected=residuals)
+    serve(data, outDir, port, args.extent, args.template)
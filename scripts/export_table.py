@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+import argparse
+from os.path import abspath
+
+from util import delimiter_dict, read_table, write_table
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Convert a table written by the pipeline among csv, parquet, and feather '
+                                                'formats, formats are determined by file extensions')
+
+    parser.add_argument('-i', '--input', required=True, help='a csv/tsv/parquet/feather table')
+    parser.add_argument('-o', '--output', required=True, help='output table e.g. zscores.csv')
+    parser.add_argument('-d', '--delimiter', default='comma', help='delimiter used in text tables '
+                                                                   '{comma,tab,space,semicolon}, default: %(default)s')
+
+    args= parser.parse_args()
+
+    df= read_table(abspath(args.input), delimiter_dict[args.delimiter])
+    write_table(df, abspath(args.output), delimiter_dict[args.delimiter])
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import argparse
+from os import cpu_count, makedirs
+from os.path import isdir, abspath, splitext, join as pjoin
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+from patsy import dmatrix
+
+from util import read_table, write_table, table_name
+from scores import standardize
+from fs_archive import exists, load_mgh
+
+# a subjects x features matrix too large for a DataFrame e.g. vertex-wise thickness on fsaverage
+# is kept in {prefix}.npy and memory-mapped, subject ids and feature names are kept in
+# {prefix}.subjects and {prefix}.features, one per line
+BLOCK= 4096
+PAGE_SIZE= 100
+MAX_NAMES= 20
+HEMIS= ['lh', 'rh']
+
+
+def sidecars(filename):
+
+    prefix= splitext(filename)[0]
+
+    return prefix+ '.subjects', prefix+ '.features'
+
+
+def create_matrix(filename, subjects, features, dtype=np.float32):
+    '''
+    :return: a writable memory-mapped subjects x features matrix
+    '''
+
+    for names, sidecar in zip([subjects, features], sidecars(filename)):
+        with open(sidecar, 'w') as f:
+            f.write(''.join(f'{n}\n' for n in names))
+
+    return open_memmap(filename, mode='w+', dtype=dtype, shape=(len(subjects), len(features)))
+
+
+def open_matrix(filename, mode='r'):
+    '''
+    :return: subject ids, feature names, and memory-mapped subjects x features matrix
+    '''
+
+    names= []
+    for sidecar in sidecars(filename):
+        with open(sidecar) as f:
+            names.append(np.array(f.read().splitlines(), dtype=object))
+
+    return names[0], names[1], np.load(filename, mmap_mode=mode)
+
+
+def column_blocks(num_features, block=BLOCK):
+
+    for start in range(0, num_features, block):
+        yield slice(start, min(start+block, num_features))
+
+
+def table_to_matrix(df, filename):
+    '''
+    :param df: subjects x features table, first column is subject ids
+    '''
+
+    X= create_matrix(filename, df[df.columns[0]].astype(str), df.columns[1:])
+    X[:]= df[df.columns[1:]].values
+    X.flush()
+
+
+def surface_files(fsdir, measure='thickness', fwhm=10, target='fsaverage'):
+    '''
+    :return: surf/{lh,rh}.{measure}.fwhm{fwhm}.{target}.mgh written by recon-all -qcache
+    '''
+
+    return [pjoin(fsdir, 'surf', f'{hemi}.{measure}.fwhm{fwhm}.{target}.mgh') for hemi in HEMIS]
+
+
+def _write_row(filename, i, files):
+
+    X= np.load(filename, mmap_mode='r+')
+    X[i]= np.concatenate([np.asarray(load_mgh(f).dataobj).ravel() for f in files])
+    X.flush()
+
+
+def surfaces_to_matrix(cases, fsdirs, filename, measure='thickness', fwhm=10, target='fsaverage', ncpu=None):
+    '''
+    Write vertex-wise measure of subjects into a feature matrix, each subject is loaded and written
+    into its row by one of ncpu processes, subjects without surface files are skipped
+    :return: subject ids in the matrix
+    '''
+
+    files= [surface_files(fsdir, measure, fwhm, target) for fsdir in fsdirs]
+    valid= [i for i in range(len(cases)) if all(exists(f) for f in files[i])]
+    if not valid:
+        raise FileNotFoundError(f'None of the subjects have surf/?h.{measure}.fwhm{fwhm}.{target}.mgh')
+
+    num_vertices= [load_mgh(f).shape[0] for f in files[valid[0]]]
+    features= [f'{hemi}_{v}' for hemi, n in zip(HEMIS, num_vertices) for v in range(n)]
+    subjects= [cases[i] for i in valid]
+    # rows are written by the processes, the matrix is only allocated here
+    X= create_matrix(filename, subjects, features)
+    del X
+
+    ncpu= ncpu or cpu_count()
+    chunksize= max(1, len(valid)//(4*ncpu))
+    with ProcessPoolExecutor(max_workers=ncpu) as executor:
+        list(executor.map(_write_row, [filename]*len(valid), range(len(valid)), [files[i] for i in valid],
+                          chunksize=chunksize))
+
+    return subjects
+
+
+def design_matrix(subjects, df_demograph, effect, control):
+    '''
+    :return: rows of subjects having demographic info, design matrix of effect for them
+        (same as the right hand side of statsmodels formula), and control group mask
+    '''
+
+    ids= df_demograph[df_demograph.columns[0]].astype(str)
+    df_demograph= df_demograph.set_index(ids)
+    rows= [i for i, s in enumerate(subjects) if s in df_demograph.index]
+    df_demograph= df_demograph.loc[[subjects[i] for i in rows]]
+
+    D= np.asarray(dmatrix(effect, df_demograph, NA_action='raise'))
+    controls= df_demograph.eval(control).values.astype(bool)
+
+    return np.array(rows, dtype=int), D, controls
+
+
+def residualize(filename, outFile, df_demograph, control, effect, block=BLOCK):
+    '''
+    Fit features of the control group on effect by least squares, one block of columns at a time,
+    and write (predicted-given)^2 of every subject having demographic info, like correct_for_demography.py,
+    features that are zero for all controls are copied as they are
+    '''
+
+    subjects, features, Y= open_matrix(filename)
+    rows, D, controls= design_matrix(subjects, df_demograph, effect, control)
+    ctrl_rows= rows[controls]
+
+    # the pseudo-inverse of control design is shared by all features
+    P= np.linalg.pinv(D[controls])
+    R= create_matrix(outFile, subjects[rows], features)
+    for cols in column_blocks(len(features), block):
+        Yb= np.asarray(Y[:, cols], dtype=float)
+        Rb= (D @ (P @ Yb[ctrl_rows]) - Yb[rows])**2
+        skip= ~Yb[ctrl_rows].any(axis=0)
+        Rb[:, skip]= Yb[rows][:, skip]
+        R[:, cols]= Rb
+
+    R.flush()
+
+
+def zscore_matrix(filename, outFile, block=BLOCK):
+    '''
+    Write standard scores of a feature matrix one block of columns at a time, see scores.standardize()
+    '''
+
+    subjects, features, X= open_matrix(filename)
+    Z= create_matrix(outFile, subjects, features)
+    for cols in column_blocks(len(features), block):
+        Z[:, cols]= standardize(X[:, cols])
+
+    Z.flush()
+
+
+def outlier_summary(filename, extent, group_by='subjects', block=BLOCK):
+    '''
+    :param filename: zscore_matrix() output
+    :return: scores.summarize() like table accumulated over blocks of columns, only the first MAX_NAMES outliers
+        of a subject are listed, only features having outliers are included
+    '''
+
+    subjects, features, Z= open_matrix(filename)
+
+    if group_by=='subjects':
+        counts= np.zeros(len(subjects), dtype=int)
+        names= [[] for _ in subjects]
+        for cols in column_blocks(len(features), block):
+            outliers= abs(np.asarray(Z[:, cols])) > extent
+            counts+= outliers.sum(axis=1)
+            for i in np.flatnonzero(outliers.any(axis=1)):
+                if len(names[i])<MAX_NAMES:
+                    names[i]+= features[cols][outliers[i]][:MAX_NAMES-len(names[i])].tolist()
+
+        outliers= ['\n'.join(n+ (['...'] if c>len(n) else [])) for n, c in zip(names, counts)]
+        return pd.DataFrame({'Subject ID': subjects, '# of outliers': counts, 'outliers': outliers})
+
+    else:
+        rows= []
+        for cols in column_blocks(len(features), block):
+            outliers= abs(np.asarray(Z[:, cols])) > extent
+            counts= outliers.sum(axis=0)
+            for j in np.flatnonzero(counts):
+                rows.append([features[cols.start+j], int(counts[j]), '\n'.join(subjects[outliers[:, j]])])
+
+        return pd.DataFrame(rows, columns=['Regions', '# of outliers', 'outliers'])
+
+
+def num_pages(filename, size=PAGE_SIZE):
+
+    _, features, _= open_matrix(filename)
+
+    return int(np.ceil(len(features)/size))
+
+
+def page(filename, number, size=PAGE_SIZE, id_col_hdr='subject'):
+    '''
+    :return: subjects x features table of the number-th page of size features
+    '''
+
+    subjects, features, X= open_matrix(filename)
+    cols= slice(number*size, min((number+1)*size, len(features)))
+    df= pd.DataFrame(np.asarray(X[:, cols]), columns=features[cols])
+    df.insert(0, id_col_hdr, subjects)
+
+    return df
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Outlier analysis of very high dimensional features e.g. vertex-wise '
+                                                'thickness, keeping features in a memory-mapped matrix and processing '
+                                                'them one block of columns at a time',
+                                    formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-i', '--input',
+                        help='a subjects x features table, or a feature matrix (.npy) written by this program')
+    parser.add_argument('-t', '--template',
+                        help='freesurfer directory pattern to build the feature matrix from, enclosed in double '
+                             'quotes e.g. "/path/to/derivatives/pnlpipe/sub-*/anat/freesurfer"')
+    parser.add_argument('-c', '--caselist', help='subject ids for --template, discovered from it if not provided')
+    parser.add_argument('--measure', default='thickness', help='vertex-wise measure, default: %(default)s')
+    parser.add_argument('--fwhm', default=10, type=int, help='smoothing of recon-all -qcache, default: %(default)s')
+    parser.add_argument('--target', default='fsaverage', help='common surface, default: %(default)s')
+    parser.add_argument('-o', '--output', required=True, help='a directory where outlier analysis results are saved')
+    parser.add_argument('-p', '--participants', help='a csv file containing demographic info, first column is subject '
+                                                     'ids, features are residualized if provided')
+    parser.add_argument('--control', help='healthy control subjects to filter from --participants, see '
+                                          'combine_demography.py -h')
+    parser.add_argument('-e', '--effect', help='effect of demographic variable to be predicted, see '
+                                               'correct_for_demography.py -h')
+    parser.add_argument('-x', '--extent', type=float, default=2, help='acceptable zscore, default: %(default)s')
+    parser.add_argument('-b', '--block', type=int, default=BLOCK,
+                        help='number of features processed at a time, default: %(default)s')
+    parser.add_argument('-n', '--ncpu', type=int, default=None,
+                        help='number of processes for loading surfaces, default: number of cores')
+
+    args= parser.parse_args()
+    if not (args.input or args.template):
+        parser.error('provide one of --input or --template')
+    if args.participants and not (args.control and args.effect):
+        parser.error('--control and --effect are required with --participants')
+
+    outDir= abspath(args.output)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
+
+    filename= pjoin(outDir, 'features.npy')
+    if args.template:
+        from scan_subjects import subjects_index
+
+        cases= None
+        if args.caselist:
+            with open(args.caselist) as f:
+                cases= f.read().split()
+        index= subjects_index(args.template, outDir, cases)
+        surfaces_to_matrix(index['subject'].tolist(), index['fsdir'].tolist(), filename, args.measure, args.fwhm,
+                           args.target, args.ncpu)
+    elif args.input.endswith('.npy'):
+        filename= abspath(args.input)
+    else:
+        table_to_matrix(read_table(abspath(args.input), converters={0: str}), filename)
+
+    if args.participants:
+        residuals= pjoin(outDir, 'residuals.npy')
+        residualize(filename, residuals, read_table(abspath(args.participants), converters={0: str}),
+                    args.control, args.effect, args.block)
+        filename= residuals
+
+    zfile= pjoin(outDir, 'zscores.npy')
+    zscore_matrix(filename, zfile, args.block)
+
+    for group_by in ['subjects', 'regions']:
+        write_table(outlier_summary(zfile, args.extent, group_by, args.block),
+                    table_name(pjoin(outDir, f'outliers-by-{group_by}')))
+
+    print('Standard scores are saved in', zfile)
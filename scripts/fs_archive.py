@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+import re
+import gzip
+import tarfile
+import zipfile
+from os import stat, listdir
+from os.path import isfile, isdir
+
+# freesurfer directories can be archived as a whole, paths inside an archive are written as
+# /path/to/sub-01.tar.gz/freesurfer/stats/aseg.stats i.e. /path/to/archive/member
+ARCHIVE_EXT= ('.tar.gz', '.tgz', '.tar', '.zip')
+_archive_path= re.compile(r'^(.*?(?:\.tar\.gz|\.tgz|\.tar|\.zip))(?:[\\/](.*))?$')
+
+# member names of archives listed in this process, keyed by (archive, mtime, size)
+_names= {}
+
+
+def split_archive(path):
+    '''
+    :return: (archive, member) if path is within an archive, (None, path) otherwise
+    '''
+
+    match= _archive_path.match(path)
+    if match and isfile(match.group(1)):
+        return match.group(1), (match.group(2) or '').replace('\\', '/')
+
+    return None, path
+
+
+def stamp(path):
+    '''
+    :return: (mtime, size) of path, or of the archive it is in, None if it does not exist
+    members are stamped by their archive without listing it, which would read a compressed tar file through,
+    a missing member is reported by read_members() once the archive is read
+    '''
+
+    archive, member= split_archive(path)
+    try:
+        s= stat(archive or path)
+    except FileNotFoundError:
+        return None
+
+    return (s.st_mtime, s.st_size)
+
+
+def archive_names(archive):
+
+    s= stat(archive)
+    key= (archive, s.st_mtime, s.st_size)
+    if key not in _names:
+        if archive.endswith('.zip'):
+            with zipfile.ZipFile(archive) as zf:
+                names= zf.namelist()
+        else:
+            # a compressed tar file must be read through to list its members
+            with tarfile.open(archive, 'r|*') as tf:
+                names= [tarinfo.name for tarinfo in tf]
+        _names[key]= [n.rstrip('/') for n in names]
+
+    return _names[key]
+
+
+def match_member(names, member):
+    '''
+    Archives may or may not have the subject and freesurfer directories on top,
+    so member is matched against the end of names, the shortest match is returned
+    '''
+
+    if not member:
+        return ''
+
+    matches= [n for n in names if n==member or n.endswith('/'+member)]
+
+    return min(matches, key=len) if matches else None
+
+
+def exists(path):
+
+    archive, member= split_archive(path)
+    if archive:
+        if not member:
+            return True
+        names= archive_names(archive)
+        return match_member(names, member) is not None or \
+               any(('/'+member+'/') in ('/'+n) for n in names)
+
+    return isfile(path) or isdir(path)
+
+
+def list_dir(path):
+
+    archive, member= split_archive(path)
+    if archive:
+        entries= set()
+        for n in archive_names(archive):
+            if not member:
+                entries.add(n.split('/')[0])
+                continue
+            n= '/'+n
+            i= n.find('/'+member+'/')
+            if i>=0:
+                entries.add(n[i+len(member)+2:].split('/')[0])
+        return sorted(e for e in entries if e)
+
+    return listdir(path) if isdir(path) else []
+
+
+def read_members(archive, members):
+    '''
+    Read members of an archive without extracting it, a zip file is accessed randomly
+    and a tar file is streamed once for all members
+    :return: {member: bytes}, None for members not found
+    '''
+
+    contents= {m: None for m in members}
+    if archive.endswith('.zip'):
+        with zipfile.ZipFile(archive) as zf:
+            names= zf.namelist()
+            for m in members:
+                name= match_member(names, m)
+                if name is not None:
+                    contents[m]= zf.read(name)
+
+    else:
+        # the shortest match of each member is kept like match_member(), the stream ends early only if
+        # every member is found as it is
+        found= {}
+        with tarfile.open(archive, 'r|*') as tf:
+            for tarinfo in tf:
+                if not tarinfo.isfile():
+                    continue
+                data= None
+                for m in members:
+                    if match_member([tarinfo.name], m) and (m not in found or len(tarinfo.name)<len(found[m])):
+                        if data is None:
+                            data= tf.extractfile(tarinfo).read()
+                        found[m]= tarinfo.name
+                        contents[m]= data
+                if all(found.get(m)==m for m in members):
+                    break
+
+    return contents
+
+
+def read_many(paths):
+    '''
+    Read files some of which may be within archives, each archive is opened once
+    :return: {path: bytes}, None for files not found
+    '''
+
+    contents= {}
+    archives= {}
+    for path in paths:
+        archive, member= split_archive(path)
+        if archive:
+            archives.setdefault(archive, {})[member]= path
+        elif isfile(path):
+            with open(path, 'rb') as f:
+                contents[path]= f.read()
+        else:
+            contents[path]= None
+
+    for archive, members in archives.items():
+        for member, data in read_members(archive, list(members)).items():
+            contents[members[member]]= data
+
+    return contents
+
+
+def read_bytes(path):
+
+    return read_many([path])[path]
+
+
+def load_mgh(path):
+    '''
+    Load an .mgh/.mgz image that may be within an archive
+    '''
+
+    from nibabel.freesurfer import load as fsload, MGHImage
+
+    archive, _= split_archive(path)
+    if not archive:
+        return fsload(path)
+
+    data= read_bytes(path)
+    if path.endswith('.mgz'):
+        data= gzip.decompress(data)
+
+    return MGHImage.from_bytes(data)
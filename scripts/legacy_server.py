@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+import dash
+import dash_html_components as html
+import dash_core_components as dcc
+from dash.dependencies import Input, Output
+from dash_table import DataTable
+from dash.exceptions import PreventUpdate
+from os.path import join as pjoin
+import logging
+
+from util import delimiter_dict, read_table, write_table, write_later, table_name
+from scores import zscores, summarize
+from pipeline import run_stage
+from model_store import model_regions
+from scan_subjects import lookup
+from view_roi import roi_sources
+from _table_layout import plot_graph, show_table
+from _compare_layout import plot_graph_compare, display_model
+
+# pages of generate-summary.py, analyze-stats.py, show-stats-table.py, and compare_correction.py
+# served by one process at http://localhost:summary_port/{path}
+PAGES= {'/': 'summary', '/graphs': 'graphs', '/table': 'table', '/compare': 'compare'}
+
+external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
+
+
+def load_dataset(input, outDir, delimiter='comma', corrected=None):
+    '''
+    Read and standardize tables once for all pages, standard scores are saved in outDir/outliers
+    :param corrected: residuals of input after demographic correction, analyzed instead of input if provided,
+        input is shown with them on /compare page
+    :return: {'df': analyzed table, 'zscores': its standard scores, 'raw': input or None, 'summary': {}}
+    '''
+
+    df= read_table(input, delimiter_dict[delimiter])
+    data= {'raw': None, 'summary': {}}
+    if corrected:
+        data['raw']= df
+        df= read_table(corrected)
+
+    data['df']= df
+    data['zscores']= zscores(df)
+
+    # outliers is not written again if neither input nor parameters have changed
+    outliers= table_name(pjoin(outDir, 'outliers'))
+    run_stage('outliers', lambda: write_table(data['zscores'], outliers), [input]+ ([corrected] if corrected else []),
+              [outliers], {'delimiter': delimiter}, outDir)
+
+    return data
+
+
+def _summary(data, group_by, extent, outDir):
+
+    # summaries are computed once per grouping and shared by all visitors
+    if group_by not in data['summary']:
+        dfs= summarize(data['zscores'], extent, group_by)
+        write_later(dfs, table_name(pjoin(outDir, f'group-by-{group_by}')))
+        data['summary'][group_by]= dfs
+
+    return data['summary'][group_by]
+
+
+def summary_layout(data):
+
+    links= [dcc.Link('Show stats graphs', href='/graphs', title='Show region-based outliers in graphs'),
+            ' | ', dcc.Link('Show stats table', href='/table', title='Show all outliers in table')]
+    if data['raw'] is not None:
+        links+= [' | ', dcc.Link('Compare correction', href='/compare',
+                                 title='Show outliers before and after demographic correction')]
+
+    return html.Div([
+
+        'Group outliers by: ',
+        html.Div([
+            dcc.Dropdown(
+                id='group-by',
+                options=[{'label': i, 'value': i} for i in ['subjects','regions']],
+                value='subjects'
+            ),
+        ],
+        style = {'width': '20%'}),
+
+        html.Div(links, style = {'float': 'right', 'display':'inline-block'}),
+
+        html.Br(),
+        DataTable(
+            id='summary',
+            filter_action='native',
+            sort_action='native',
+
+            style_data_conditional=[{
+                'if': {'row_index': 'odd'},
+                'backgroundColor': 'rgb(240, 240, 240)'
+            }],
+
+            style_header={
+                'backgroundColor': 'rgb(230, 230, 230)',
+                'fontWeight': 'bold'
+            },
+
+            style_cell={
+                'textAlign': 'left',
+                'whiteSpace': 'pre-wrap'
+            },
+
+        ),
+    ])
+
+
+def graphs_layout(data):
+
+    regions= data['df'].columns.values[1:]
+
+    return html.Div([
+        dcc.Link('Back to summary', href='/'),
+        html.Div([
+            dcc.Dropdown(
+                id='region',
+                options=[{'label': i, 'value': i} for i in regions],
+                value=regions[0]
+            )
+        ],
+            style={'width': '48%', 'display': 'inline-block'}),
+
+        dcc.Graph(id='stat-graph'),
+    ])
+
+
+def compare_layout(data, outDir):
+
+    regions= [r for r in data['df'].columns.values[1:] if r in model_regions(outDir)]
+
+    return html.Div([
+        dcc.Link('Back to summary', href='/'),
+        html.Div([
+            dcc.Dropdown(
+                id='compare-region',
+                options=[{'label': i, 'value': i} for i in regions],
+                value=regions[0] if regions else None
+            )
+        ],
+            style={'width': '48%', 'display': 'inline-block'}),
+
+        html.Br(),
+        'Corrected outliers, superimposed on the uncorrected ones, accounting for standard score of the residuals:',
+        dcc.Graph(id='compare-graph'),
+        'Only corrected outliers accounting for standard score of the residuals can be found at /graphs',
+        dcc.Graph(id='model-graph'),
+        html.Br(),
+        dcc.Markdown(id='model-summary'),
+        html.Br()
+    ])
+
+
+def create_app(data, outDir, extent=2, template=None):
+    '''
+    :param data: load_dataset() output
+    :return: one Dash app routing PAGES by the path of url
+    '''
+
+    app = dash.Dash(__name__, external_stylesheets=external_stylesheets, suppress_callback_exceptions=True)
+    log= logging.getLogger('werkzeug')
+    log.setLevel(logging.ERROR)
+
+    subjects= data['zscores'][data['zscores'].columns[0]].values
+    # layouts are built on the first visit of a page and reused afterwards
+    layouts= {}
+    builders= {'summary': lambda: summary_layout(data),
+               'graphs': lambda: graphs_layout(data),
+               'table': lambda: show_table(data['zscores'], extent),
+               'compare': lambda: compare_layout(data, outDir)}
+
+    app.layout = html.Div([
+        dcc.Location(id='url', refresh=False),
+        html.Div(id='page-content')
+    ])
+
+
+    @app.callback(Output('page-content', 'children'),
+                  [Input('url', 'pathname')])
+    def display_page(pathname):
+
+        page= PAGES.get(pathname, 'summary')
+        if page=='compare' and data['raw'] is None:
+            page= 'summary'
+        if page not in layouts:
+            layouts[page]= builders[page]()
+
+        return layouts[page]
+
+
+    @app.callback([Output('summary', 'data'),
+                   Output('summary', 'columns')],
+                  [Input('group-by', 'value')])
+    def update_summary(group_by):
+
+        dfs= _summary(data, group_by, extent, outDir)
+        columns = [{'name': i, 'id': i, 'hideable': True} for i in dfs.columns]
+
+        return [dfs.to_dict('records'), columns]
+
+
+    @app.callback(Output('stat-graph', 'figure'),
+                  [Input('region', 'value')])
+    def update_graph(region):
+
+        fig, _, _ = plot_graph(data['df'], region, extent)
+
+        return fig
+
+
+    @app.callback([Output('compare-graph', 'figure'),
+                   Output('model-graph', 'figure'),
+                   Output('model-summary','children')],
+                  [Input('compare-region', 'value')])
+    def update_compare(region):
+
+        if not region:
+            raise PreventUpdate
+
+        fig, _, _ = plot_graph_compare(data['raw'], data['df'], region, extent)
+        model, summary= display_model(region, outDir)
+
+        return (fig, model, summary)
+
+
+    @app.callback([Output('roi-x', 'src'), Output('roi-y', 'src'), Output('roi-z', 'src'),
+                   Output('cmd', 'children'), Output('render ROI on brain', 'displayed'),
+                   Output('roi-markdown', 'href')],
+                  [Input('table', 'selected_cells'),
+                   Input('view-type', 'value')])
+    def get_active_cell(selected_cells, view_type):
+
+        if not (selected_cells and template):
+            raise PreventUpdate
+
+        temp = selected_cells[0]
+        fsdir= lookup(template, subjects[temp['row']], outDir)
+        if not fsdir:
+            raise PreventUpdate
+
+        sources, cmd= roi_sources(temp['column_id'], fsdir, outDir, view_type)
+        msg= ['Execute the following command in a terminal:', html.Br(), html.Br(), cmd]
+
+        return sources+ [msg, True, '/table#cmd']
+
+
+    return app
+
+
+def serve(data, outDir, port, extent=2, template=None):
+    '''
+    Serve all pages of data at http://localhost:port until interrupted
+    '''
+
+    app= create_app(data, outDir, extent, template)
+    print(f'\n\nDisplaying summary at http://localhost:{port}, graphs at /graphs, and table at /table' +
+          (', and comparison at /compare' if data['raw'] is not None else '') + '\n\n')
+    app.run_server(debug=False, port= port, host= 'localhost')
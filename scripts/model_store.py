@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import json
+import numpy as np
+from glob import glob
+from shutil import copyfile
+from os import stat, replace, makedirs, remove
+from os.path import isfile, getmtime, basename, join as pjoin
+from pipeline import CACHE, CACHE_SIZE
+
+# models of all regions of a table fitted by correct_for_demography.correct() are stored in
+# outDir/.{prefix}.models.npy named after the table, one row per region: coefficients, normalized covariance, STATS,
+# and response residuals of the control group (nan where the region is missing), regions, terms, family, effect,
+# and control demographics are kept in outDir/.{prefix}.models.json, models saved without a prefix are
+# outDir/.models.npy and .json, stores having a key are also kept in outDir/.cache/models-{key}.npy and .json,
+# the CACHE_SIZE latest ones
+MODELS= '.models.npy'
+MODELS_INFO= '.models.json'
+STATS= ['scale', 'llf', 'deviance', 'pearson_chi2', 'iterations']
+
+# load_models() output of each store with the modification time it was loaded at
+_loaded= {}
+
+
+def model_files(outDir, prefix=None):
+    '''
+    :param prefix: name of the table the models are fitted on e.g. asegstats
+    :return: files of the model store of prefix in outDir
+    '''
+
+    name= f'.{prefix}' if prefix else ''
+
+    return [pjoin(outDir, name+ MODELS), pjoin(outDir, name+ MODELS_INFO)]
+
+
+def model_stores(outDir):
+    '''
+    :return: prefixes of the model stores in outDir, the one saved last first, None for a store without a prefix
+    '''
+
+    stores= sorted(glob(pjoin(outDir, '.*'+ MODELS[1:])), key=getmtime, reverse=True)
+
+    return [basename(store)[1:-len(MODELS)].rstrip('.') or None for store in stores]
+
+
+def cache_files(outDir, key):
+    '''
+    :return: files of the model store cached for key in outDir
+    '''
+
+    return [pjoin(outDir, CACHE, f'models-{key}.npy'), pjoin(outDir, CACHE, f'models-{key}.json')]
+
+
+def _copy(sources, targets):
+
+    # written aside and moved, json first, so that readers never see a partial store
+    for source, target in reversed(list(zip(sources, targets))):
+        copyfile(source, target+ '.tmp')
+    for target in reversed(targets):
+        replace(target+ '.tmp', target)
+
+
+def save_models(outDir, prefix, info, params, cov, stats, resid):
+    '''
+    :param prefix: see model_files()
+    :param info: {'regions': [...], 'terms': [...], 'family': ..., 'effect': ..., 'control': {column: values}},
+        and optionally 'key' the store is cached for, see cached_models()
+    :param params: terms x regions coefficients
+    :param cov: regions x terms x terms normalized covariance
+    :param stats: regions x STATS array
+    :param resid: control subjects x regions response residuals
+    '''
+
+    rows= np.hstack([params.T, cov.reshape(len(info['regions']), -1), stats, resid.T]).astype(float)
+
+    # written aside and moved, so that readers never see a partial store
+    models, models_info= model_files(outDir, prefix)
+    with open(models+ '.tmp', 'wb') as f:
+        np.save(f, rows)
+    with open(models_info+ '.tmp', 'w') as f:
+        json.dump(info, f, default=lambda x: x.item())
+    replace(models_info+ '.tmp', models_info)
+    replace(models+ '.tmp', models)
+
+    if 'key' in info:
+        cache= pjoin(outDir, CACHE)
+        makedirs(cache, exist_ok=True)
+        _copy(model_files(outDir, prefix), cache_files(outDir, info['key']))
+        for old in sorted(glob(pjoin(cache, 'models-*.npy')), key=getmtime)[:-CACHE_SIZE]:
+            remove(old)
+            if isfile(old[:-4]+ '.json'):
+                remove(old[:-4]+ '.json')
+
+
+def cached_models(outDir, prefix, key):
+    '''
+    Make the models cached for key the model store of prefix in outDir again instead of fitting them
+    :return: load_models() output, None if no models are cached for key
+    '''
+
+    models= load_models(outDir, prefix)
+    if models and models.get('key')==key:
+        return models
+
+    cached= cache_files(outDir, key)
+    if not all(isfile(f) for f in cached):
+        return None
+    _copy(cached, model_files(outDir, prefix))
+
+    return load_models(outDir, prefix)
+
+
+def load_models(outDir, prefix=None):
+    '''
+    Memory-map the model store of prefix in outDir once, and again only after it has been saved again
+    :return: info of save_models() with 'params' regions x terms, 'cov' regions x terms x terms,
+        'stats' {name: regions}, and 'resid' regions x control subjects views of the store, None if there is no store
+    '''
+
+    models, models_info= model_files(outDir, prefix)
+    if not isfile(models):
+        return None
+
+    mtime= stat(models).st_mtime_ns
+    if models in _loaded and _loaded[models][0]==mtime:
+        return _loaded[models][1]
+
+    with open(models_info) as f:
+        info= json.load(f)
+    rows= np.load(models, mmap_mode='r')
+
+    p= len(info['terms'])
+    info['params']= rows[:, :p]
+    info['cov']= rows[:, p:p+p*p].reshape(-1, p, p)
+    info['stats']= {name: rows[:, p+p*p+i] for i, name in enumerate(STATS)}
+    info['resid']= rows[:, p+p*p+len(STATS):]
+    _loaded[models]= (mtime, info)
+
+    return info
+
+
+def find_models(outDir, region):
+    '''
+    :return: load_models() output of the store saved last having a model of region in outDir, None if there is none
+    '''
+
+    for prefix in model_stores(outDir):
+        models= load_models(outDir, prefix)
+        if models and region in models['regions']:
+            return models
+
+    return None
+
+
+def model_regions(outDir):
+    '''
+    :return: regions having a model in any store of outDir
+    '''
+
+    regions= set()
+    for prefix in model_stores(outDir):
+        models= load_models(outDir, prefix)
+        regions.update(models['regions'] if models else [])
+
+    return regions
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import json
+import pickle
+from glob import glob
+from hashlib import sha1
+from os import stat, makedirs, remove
+from os.path import isfile, getmtime, join as pjoin
+
+# stages of a pipeline run in outDir are recorded in outDir/.pipeline.json as
+# {stage: {'inputs': signature of inputs and parameters, 'outputs': {output: (mtime, size)}}}
+STATE= '.pipeline.json'
+# results of stages keyed by content hash of their inputs are stored in outDir/.cache/{stage}-{key}.pkl as
+# {'result': result, 'outputs': {output: (mtime, size)}}, only the CACHE_SIZE latest ones of a stage are kept
+CACHE= '.cache'
+CACHE_SIZE= 8
+BLOCK= 2**20
+
+
+def _stamp(filename):
+
+    try:
+        s= stat(filename)
+    except FileNotFoundError:
+        return None
+
+    return [s.st_mtime, s.st_size]
+
+
+def signature(inputs, params=None):
+    '''
+    :param inputs: input files
+    :param params: parameters of the stage e.g. {'effect': 'age'}
+    :return: a digest of paths, modification times, and sizes of inputs, and params
+    '''
+
+    content= json.dumps([[f, _stamp(f)] for f in inputs]+ [params], sort_keys=True, default=str)
+
+    return sha1(content.encode()).hexdigest()
+
+
+def _load_state(outDir):
+
+    filename= pjoin(outDir, STATE)
+    if not isfile(filename):
+        return {}
+
+    with open(filename) as f:
+        return json.load(f)
+
+
+def up_to_date(name, inputs, outputs, params, outDir):
+    '''
+    A stage is up to date if neither its inputs and parameters nor its outputs have changed since it was last run
+    '''
+
+    record= _load_state(outDir).get(name)
+    if not record or record['inputs']!=signature(inputs, params):
+        return False
+
+    return all(_stamp(f) is not None and _stamp(f)==record['outputs'].get(f) for f in outputs)
+
+
+def run_stage(name, func, inputs, outputs, params, outDir):
+    '''
+    Run func() unless the stage is up to date, like make
+    :return: True if func() was run, False if skipped
+    '''
+
+    if up_to_date(name, inputs, outputs, params, outDir):
+        print(f'{name} is up to date, skipping')
+        return False
+
+    func()
+
+    state= _load_state(outDir)
+    state[name]= {'inputs': signature(inputs, params), 'outputs': {f: _stamp(f) for f in outputs}}
+    with open(pjoin(outDir, STATE), 'w') as f:
+        json.dump(state, f, indent=2)
+
+    return True
+
+
+def content_hash(*parts):
+    '''
+    :param parts: bytes, str, or None e.g. uploaded contents, control expression, effect formula, delimiter
+    :return: a digest of parts that does not depend on where one part ends and the next begins
+    '''
+
+    digest= sha1()
+    for part in parts:
+        part= b'' if part is None else part if isinstance(part, bytes) else str(part).encode()
+        digest.update(f'{len(part)}:'.encode())
+        digest.update(part)
+
+    return digest.hexdigest()
+
+
+def file_hash(filename):
+    '''
+    :return: a digest of the content of filename, read BLOCK bytes at a time
+    '''
+
+    digest= sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def cached_result(name, key, outDir):
+    '''
+    :return: stored result of a stage for key, None if it has not been stored or files it wrote have changed since
+    '''
+
+    filename= pjoin(outDir, CACHE, f'{name}-{key}.pkl')
+    if not isfile(filename):
+        return None
+
+    with open(filename, 'rb') as f:
+        record= pickle.load(f)
+    if not all(_stamp(output)==stamp for output, stamp in record['outputs'].items()):
+        return None
+
+    return record['result']
+
+
+def cached_stage(name, key, func, outDir):
+    '''
+    Return the stored result of a stage for the same key unless files it wrote have changed since,
+    otherwise run func() and store its result
+    :param key: content_hash() of inputs of the stage
+    :param func: returns its result and the files it wrote
+    :return: result of func()
+    '''
+
+    result= cached_result(name, key, outDir)
+    if result is not None:
+        print(f'{name} is cached, skipping')
+        return result
+
+    cache= pjoin(outDir, CACHE)
+    filename= pjoin(cache, f'{name}-{key}.pkl')
+    result, outputs= func()
+
+    makedirs(cache, exist_ok=True)
+    with open(filename, 'wb') as f:
+        pickle.dump({'result': result, 'outputs': {output: _stamp(output) for output in outputs}}, f)
+
+    for old in sorted(glob(pjoin(cache, f'{name}-*.pkl')), key=getmtime)[:-CACHE_SIZE]:
+        remove(old)
+
+    return result
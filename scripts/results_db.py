@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+import argparse
+import sqlite3
+from time import time
+from os.path import isfile, abspath, join as pjoin
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from model_store import load_models
+from pipeline import CACHE_SIZE
+
+# results of analyses in outDir are stored in outDir/.results.db, one run per content key of the analysis,
+# subjects and regions of a run are numbered in the order of the analyzed table, only the CACHE_SIZE runs
+# stored or reopened last are kept
+RESULTS= '.results.db'
+SCHEMA= '''
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, key TEXT UNIQUE, opened REAL, subjects TEXT);
+CREATE TABLE IF NOT EXISTS subjects (run INTEGER, idx INTEGER, name, PRIMARY KEY (run, idx)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS subjects_name ON subjects (run, name);
+CREATE TABLE IF NOT EXISTS regions (run INTEGER, idx INTEGER, name TEXT, PRIMARY KEY (run, idx)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS regions_name ON regions (run, name);
+CREATE TABLE IF NOT EXISTS scores (run INTEGER, subject INTEGER, region INTEGER, raw REAL, residual REAL, zscore REAL,
+                                   PRIMARY KEY (run, subject, region)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scores_region ON scores (run, region, subject);
+CREATE INDEX IF NOT EXISTS scores_outlier ON scores (run, abs(zscore));
+CREATE TABLE IF NOT EXISTS coefficients (run INTEGER, region INTEGER, term TEXT, estimate REAL, stderr REAL,
+                                         pvalue REAL, PRIMARY KEY (run, region, term)) WITHOUT ROWID;
+'''
+
+
+def connect(outDir):
+
+    con= sqlite3.connect(pjoin(outDir, RESULTS))
+    con.executescript(SCHEMA)
+
+    return con
+
+
+def find_run(outDir, key):
+    '''
+    :return: id of the run stored for key, None if there is none
+    '''
+
+    if not isfile(pjoin(outDir, RESULTS)):
+        return None
+
+    with connect(outDir) as con:
+        row= con.execute('SELECT id FROM runs WHERE key=?', (key,)).fetchone()
+
+    return row[0] if row else None
+
+
+def current_run(outDir):
+    '''
+    :return: id of the run stored or reopened last in outDir, None if there is none
+    '''
+
+    if not isfile(pjoin(outDir, RESULTS)):
+        return None
+
+    with connect(outDir) as con:
+        row= con.execute('SELECT id FROM runs ORDER BY opened DESC LIMIT 1').fetchone()
+
+    return row[0] if row else None
+
+
+def _insert_scores(con, run, start, df_scores, df_raw, df_resid):
+
+    regions= df_scores.columns[1:]
+    ids= pd.read_sql('SELECT idx, name FROM regions WHERE run=?', con, params=(run,), index_col='name')['idx']
+
+    # one row per subject and region, residual is NULL if the run is not corrected
+    long= df_scores.melt(id_vars=df_scores.columns[0], value_vars=regions, var_name='region', value_name='zscore')
+    long['subject']= np.tile(start+ np.arange(len(df_scores)), len(regions))
+    long['region']= ids.loc[long['region']].values
+    long['raw']= df_raw[regions].melt()['value'].values
+    long['residual']= df_resid[regions].melt()['value'].values if df_resid is not None else None
+
+    con.executemany('INSERT INTO subjects VALUES (?,?,?)',
+                    [(run, start+i, id) for i, id in enumerate(df_scores[df_scores.columns[0]].tolist())])
+    con.executemany('INSERT INTO scores VALUES (?,?,?,?,?,?)',
+                    zip([run]*len(long), long['subject'].tolist(), long['region'].tolist(),
+                        long['raw'].astype(float).tolist(), long['residual'].astype(float).tolist(),
+                        long['zscore'].astype(float).tolist()))
+
+
+def _prune(con):
+
+    old= [(run,) for run, in con.execute('SELECT id FROM runs ORDER BY opened DESC LIMIT -1 OFFSET ?', (CACHE_SIZE,))]
+    for table in ['scores', 'subjects', 'regions', 'coefficients']:
+        con.executemany(f'DELETE FROM {table} WHERE run=?', old)
+    con.executemany('DELETE FROM runs WHERE id=?', old)
+
+
+def store_run(outDir, key, df_scores, df_raw, df_resid=None, prefix=None):
+    '''
+    Store raw values, residuals, standard scores, and model coefficients of an analysis, once for the same key
+    :param key: content hash of the analysis e.g. app.load_cached() key
+    :param df_scores: standard scores, see scores.zscores()
+    :param df_raw: table analyzed or combined with demographics, rows in the order of df_scores
+    :param df_resid: residuals if corrected, coefficients are read from the model store outDir/.{prefix}.models.npy
+    :return: id of the run
+    '''
+
+    with connect(outDir) as con:
+        row= con.execute('SELECT id FROM runs WHERE key=?', (key,)).fetchone()
+        if row:
+            con.execute('UPDATE runs SET opened=? WHERE id=?', (time(), row[0]))
+            return row[0]
+
+        run= con.execute('INSERT INTO runs VALUES (NULL,?,?,?)', (key, time(), df_scores.columns[0])).lastrowid
+        _prune(con)
+        regions= df_scores.columns[1:].tolist()
+        con.executemany('INSERT INTO regions VALUES (?,?,?)', [(run, j, r) for j, r in enumerate(regions)])
+        _insert_scores(con, run, 0, df_scores, df_raw, df_resid)
+
+        models= load_models(outDir, prefix) if df_resid is not None else None
+        if models:
+            # standard errors and Wald p values as in statsmodels GLM results
+            params= np.array(models['params'])
+            cov= np.diagonal(models['cov'], axis1=1, axis2=2)* models['stats']['scale'][:, None]
+            bse= np.sqrt(cov)
+            pvalues= 2*norm.sf(np.abs(params/bse))
+            rows= []
+            for i, region in enumerate(models['regions']):
+                if region in regions:
+                    j= regions.index(region)
+                    rows+= [(run, j, term, float(params[i, k]), float(bse[i, k]), float(pvalues[i, k]))
+                            for k, term in enumerate(models['terms'])]
+            con.executemany('INSERT INTO coefficients VALUES (?,?,?,?,?,?)', rows)
+
+    return run
+
+
+def append_subjects(outDir, run, df_scores, df_raw, df_resid=None):
+    '''
+    Append subjects scored against an existing run e.g. by watch.py
+    :return: False if regions of df_scores are not of the run
+    '''
+
+    with connect(outDir) as con:
+        regions= [r for r, in con.execute('SELECT name FROM regions WHERE run=? ORDER BY idx', (run,))]
+        if regions!=df_scores.columns[1:].tolist():
+            return False
+
+        start= con.execute('SELECT count(*) FROM subjects WHERE run=?', (run,)).fetchone()[0]
+        _insert_scores(con, run, start, df_scores, df_raw, df_resid)
+
+    return True
+
+
+def _names(con, table, run):
+
+    return [name for name, in con.execute(f'SELECT name FROM {table} WHERE run=? ORDER BY idx', (run,))]
+
+
+def outliers(outDir, run, extent, subject=None, region=None):
+    '''
+    :param subject: id of a subject whose outliers are returned, all subjects if None
+    :param region: name of a region whose outliers are returned, all regions if None
+    :return: subject, region, and standard score of outliers beyond extent, one per row
+    '''
+
+    query= 'SELECT s.name AS subject, r.name AS region, raw, residual, zscore FROM scores ' \
+           'JOIN subjects s ON s.run=scores.run AND s.idx=scores.subject ' \
+           'JOIN regions r ON r.run=scores.run AND r.idx=scores.region WHERE scores.run=? AND abs(zscore)>?'
+    params= [run, float(extent)]
+    if subject is not None:
+        # ids are stored as they were read, numeric ones as numbers unless read as text e.g. by watch.py
+        subject= subject.item() if isinstance(subject, np.generic) else subject
+        names= [subject, int(subject)] if isinstance(subject, str) and subject.isdigit() else [subject, str(subject)]
+        query+= ' AND scores.subject IN (SELECT idx FROM subjects WHERE run=? AND name IN (?,?))'
+        params+= [run]+ names
+    if region is not None:
+        query+= ' AND scores.region IN (SELECT idx FROM regions WHERE run=? AND name=?)'
+        params+= [run, region]
+
+    with connect(outDir) as con:
+        return pd.read_sql(query+ ' ORDER BY scores.subject, scores.region', con, params=params)
+
+
+def summary(outDir, run, extent, group_by='subjects', more_than=None):
+    '''
+    Look outliers up in the index of standard scores instead of reading the zscores table
+    :param more_than: only subjects or regions with more outliers than this are returned if provided
+    :return: scores.summarize() output for the run
+    '''
+
+    with connect(outDir) as con:
+        subjects= _names(con, 'subjects', run)
+        regions= _names(con, 'regions', run)
+        # unary + keeps the primary key from being chosen over the index of absolute scores for ordering
+        hits= con.execute('SELECT subject, region FROM scores WHERE run=? AND abs(zscore)>? ORDER BY +subject, +region',
+                          (run, float(extent))).fetchall()
+
+    if group_by=='subjects':
+        columns, names, members= ['Subject ID', '# of outliers', 'outliers'], subjects, regions
+    else:
+        columns, names, members= ['Regions', '# of outliers', 'outliers'], regions, subjects
+        hits= sorted((region, subject) for subject, region in hits)
+
+    found= [[] for _ in names]
+    for i, j in hits:
+        found[i].append(str(members[j]))
+
+    dfs= pd.DataFrame({columns[0]: names, columns[1]: [len(f) for f in found],
+                       columns[2]: ['\n'.join(f) for f in found]})
+    if more_than is not None:
+        dfs= dfs[dfs[columns[1]]>more_than].reset_index(drop=True)
+
+    return dfs
+
+
+def score_table(outDir, run, value='zscore'):
+    '''
+    :param value: raw, residual, or zscore
+    :return: subjects x regions table of value for the run
+    '''
+
+    with connect(outDir) as con:
+        subjects= _names(con, 'subjects', run)
+        regions= _names(con, 'regions', run)
+        id= con.execute('SELECT subjects FROM runs WHERE id=?', (run,)).fetchone()[0]
+        df= pd.read_sql(f'SELECT subject, region, {value} FROM scores WHERE run=?', con, params=(run,))
+
+    table= df.pivot(index='subject', columns='region', values=value).sort_index()
+    table.columns= [regions[j] for j in table.columns]
+    table.insert(0, id, subjects)
+
+    return table[[id]+ regions].reset_index(drop=True)
+
+
+def coefficients(outDir, run, region=None):
+    '''
+    :return: estimate, standard error, and p value of each term of the models of the run
+    '''
+
+    query= 'SELECT r.name AS region, term, estimate, stderr, pvalue FROM coefficients c ' \
+           'JOIN regions r ON r.run=c.run AND r.idx=c.region WHERE c.run=?'
+    params= [run]
+    if region is not None:
+        query+= ' AND r.name=?'
+        params.append(region)
+
+    with connect(outDir) as con:
+        return pd.read_sql(query+ ' ORDER BY c.region', con, params=params)
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Query the results of the last analysis in an output directory '
+                                                'without reading its tables',
+                                    formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-o', '--output', required=True, help='a directory analyzed by the web application, '
+                                                              'batch.py, or watch.py')
+    parser.add_argument('-x', '--extent', type=float, default=2, help='acceptable zscore, default: %(default)s')
+    parser.add_argument('-s', '--subject', help='show outliers of this subject')
+    parser.add_argument('-r', '--region', help='show outliers in this region, and its model coefficients if corrected')
+    parser.add_argument('-g', '--group-by', choices=['subjects', 'regions'], default='regions',
+                        help='summarize outliers by subjects or regions, default: %(default)s')
+    parser.add_argument('-k', '--more-than', type=int, default=0,
+                        help='summarize only subjects or regions with more outliers than this, default: %(default)s')
+
+    args= parser.parse_args()
+    outDir= abspath(args.output)
+    run= current_run(outDir)
+    if run is None:
+        exit(f'No results are stored in {outDir}, analyze first')
+
+    pd.set_option('display.max_rows', None)
+    if args.subject or args.region:
+        print(outliers(outDir, run, args.extent, args.subject, args.region).to_string(index=False))
+        if args.region:
+            print('\n'+ coefficients(outDir, run, args.region).to_string(index=False))
+    else:
+        print(summary(outDir, run, args.extent, args.group_by, args.more_than).to_string(index=False))
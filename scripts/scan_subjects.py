@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import argparse
+import re
+from os import scandir, makedirs
+from os.path import isfile, isdir, dirname, basename, abspath, join as pjoin
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+from util import read_table, write_table, table_name
+from fs_archive import ARCHIVE_EXT, exists, list_dir
+
+NUM_THREADS= 16
+COLUMNS= ['subject', 'fsdir', 'recon_all_done', 'stats', 'aseg']
+
+# indices loaded in this process, keyed by index file
+_indices= {}
+
+
+def expand_template(template):
+    '''
+    Discover subjects by listing the directory that contains * of template
+    :param template: freesurfer directory pattern e.g. /path/to/derivatives/pnlpipe/sub-*/anat/freesurfer,
+        or within subject archives e.g. /path/to/archives/sub-*.tar.gz/freesurfer
+    :return: {subject id: freesurfer directory}
+    '''
+
+    head, _, tail= template.partition('*')
+    parent, prefix= dirname(head), basename(head)
+    # remainder of the path component having *, and the rest of the path
+    suffix, rest= re.match(r'([^\\/]*)(.*)', tail).groups()
+
+    subjects= {}
+    if not isdir(parent):
+        return subjects
+
+    with scandir(parent) as entries:
+        for entry in entries:
+            name= entry.name
+            if len(name)>len(prefix)+len(suffix) and name.startswith(prefix) and name.endswith(suffix) \
+                    and (entry.is_dir() or (entry.is_file() and suffix.endswith(ARCHIVE_EXT))):
+                id= name[len(prefix):len(name)-len(suffix)]
+                subjects[id]= pjoin(parent, name)+ rest
+
+    return dict(sorted(subjects.items()))
+
+
+def check_subject(fsdir):
+    '''
+    :return: completeness of a freesurfer directory as [recon_all_done, stats, aseg]
+    '''
+
+    stats= any(name.endswith('.stats') for name in list_dir(pjoin(fsdir, 'stats')))
+
+    return [exists(pjoin(fsdir, 'scripts', 'recon-all.done')), stats, exists(pjoin(fsdir, 'mri', 'aseg.mgz'))]
+
+
+def complete(row):
+
+    return bool(row['recon_all_done'] and row['stats'] and row['aseg'])
+
+
+def scan(template, cases=None, index=None, nthreads=NUM_THREADS):
+    '''
+    :param cases: subject ids, discovered from template if not provided
+    :param index: an earlier scan() output, complete subjects in it are not checked again
+    :return: DataFrame with COLUMNS, one row per subject
+    '''
+
+    if cases is None:
+        fsdirs= expand_template(template)
+    else:
+        fsdirs= {str(c): template.replace('*', str(c)) for c in cases}
+
+    known= {}
+    if index is not None:
+        for _, row in index.iterrows():
+            if complete(row) and row['fsdir']==fsdirs.get(str(row['subject'])):
+                known[str(row['subject'])]= row.tolist()
+
+    todo= [id for id in fsdirs if id not in known]
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        checks= dict(zip(todo, executor.map(check_subject, [fsdirs[id] for id in todo])))
+
+    rows= [known[id] if id in known else [id, fsdirs[id]]+ checks[id] for id in fsdirs]
+
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def index_file(outDir):
+
+    return table_name(pjoin(outDir, '.subjects_index'))
+
+
+def subjects_index(template, outDir, cases=None, nthreads=NUM_THREADS):
+    '''
+    Load the index of freesurfer directories persisted in outDir, update it for new or incomplete subjects,
+    and persist it again
+    '''
+
+    filename= index_file(outDir)
+    index= _indices.get(filename)
+    if index is None and isfile(filename):
+        index= read_table(filename, dtype={'subject': str})
+
+    index= scan(template, cases, index, nthreads)
+    write_table(index, filename)
+    _indices[filename]= index
+
+    return index
+
+
+def lookup(template, subject, outDir):
+    '''
+    :return: freesurfer directory of subject if it has mri/aseg.mgz, None otherwise
+    subjects not found in the index are checked and added to the index, incomplete ones are checked again
+    '''
+
+    subject= str(subject)
+    filename= index_file(outDir)
+    index= _indices.get(filename)
+    if index is None and isfile(filename):
+        index= _indices[filename]= read_table(filename, dtype={'subject': str})
+
+    fsdir= template.replace('*', subject)
+    if index is None or fsdir not in index['fsdir'].values:
+        known= [] if index is None else index['subject'].tolist()
+        index= subjects_index(template, outDir, known+[subject])
+    else:
+        # incomplete subjects are checked again like scan() does, they may have finished since they were indexed
+        rows= index['fsdir']==fsdir
+        if not complete(index[rows].iloc[0]):
+            checks= check_subject(fsdir)
+            if checks!=index.loc[rows, COLUMNS[2:]].iloc[0].tolist():
+                index.loc[rows, COLUMNS[2:]]= checks
+                write_table(index, filename)
+
+    row= index[index['fsdir']==fsdir].iloc[0]
+
+    return fsdir if row['aseg'] else None
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Discover freesurfer directories from a template, check their '
+                                                'completeness, and save the result as an index in the output directory')
+
+    parser.add_argument('-t', '--template', required=True,
+                        help='freesurfer directory pattern enclosed in double quotes e.g. '
+                             '"/path/to/*/freesurfer" or "/path/to/derivatives/pnlpipe/sub-*/anat/freesurfer", '
+                             'where * is the placeholder for subject id')
+    parser.add_argument('-c', '--caselist', help='subject ids, discovered from --template if not provided')
+    parser.add_argument('-o', '--output', required=True, help='a directory where the index is saved')
+    parser.add_argument('-n', '--nthreads', type=int, default=NUM_THREADS,
+                        help='number of concurrent checks, default: %(default)s')
+
+    args= parser.parse_args()
+    outDir= abspath(args.output)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
+
+    cases= None
+    if args.caselist:
+        with open(args.caselist) as f:
+            cases= f.read().split()
+
+    index= subjects_index(args.template, outDir, cases, args.nthreads)
+    num_complete= sum(complete(row) for _, row in index.iterrows())
+    print(f'{num_complete} of {len(index)} freesurfer directories are complete, see {index_file(outDir)}')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import argparse
+from os.path import isfile, abspath, join as pjoin
+import numpy as np
+import pandas as pd
+from util import delimiter_dict, read_table, write_table, table_name
+from combine_demography import combine
+from correct_for_demography import predict, control_scores
+from model_store import load_models, model_files, model_stores
+from scores import summarize
+
+# subjects whose residuals new subjects are standardized against: all subjects of the analysis, like zscores.csv and
+# watch.py, or the control group the models were fitted on
+REFERENCES= ['cohort', 'controls']
+
+
+def cohort_scores(outDir, prefix, models):
+    '''
+    :return: mean and standard deviation of residuals=(predicted-given)^2 of the subjects analyzed in outDir
+        in each modeled region
+    '''
+
+    exog= '_'.join(models['effect'].split('+'))
+    filename= table_name(pjoin(outDir, f'{prefix}_{exog}_residuals'))
+    if not isfile(filename):
+        raise FileNotFoundError(f'{filename} does not exist, standardize against controls instead')
+
+    X= read_table(filename)[models['regions']].values.astype(float)
+
+    return X.mean(axis=0), X.std(axis=0)
+
+
+def score_subjects(outDir, df, df_demograph, prefix=None, reference='cohort'):
+    '''
+    Correct and standardize new subjects by the models saved in outDir without fitting them again
+    :param df: subjects x regions table of new subjects, first column is subject ids
+    :param df_demograph: demographic info of the subjects, see combine_demography.combine()
+    :param prefix: name of the table the models are fitted on e.g. asegstats, default: the one saved last in outDir
+    :param reference: one of REFERENCES, residuals=(predicted-given)^2 are standardized against those of the subjects
+        analyzed in outDir, or of the control group the models were fitted on
+    :return: residuals and standard scores of modeled regions, one row per subject having demographic info,
+        and subjects without demographic info
+    '''
+
+    if reference not in REFERENCES:
+        raise ValueError(f'reference must be one of {REFERENCES}, found {reference}')
+    if prefix is None:
+        prefix= next(iter(model_stores(outDir)), None)
+    models= load_models(outDir, prefix)
+    if models is None:
+        raise FileNotFoundError(f'{model_files(outDir, prefix)[0]} does not exist, run correct_for_demography.py first')
+
+    regions= models['regions']
+    missing= [region for region in regions if region not in df.columns]
+    if missing:
+        raise ValueError(f'{missing} are modeled in {outDir} but not given')
+
+    dfcomb, unmatched= combine(df, df_demograph)
+    X= (predict(models, dfcomb)- dfcomb[regions].values.astype(float))**2
+
+    # same as scores.standardize() with the mean and standard deviation of the reference
+    mean, std= cohort_scores(outDir, prefix, models) if reference=='cohort' else control_scores(models)
+    nonzero= std>0
+    Z= np.zeros(X.shape)
+    Z[:, nonzero]= np.round((X[:, nonzero]- mean[nonzero])/std[nonzero], 4)
+
+    ids= dfcomb[df.columns[0]].values
+    df_resid= pd.DataFrame(X, columns=regions)
+    df_resid.insert(0, df.columns[0], ids)
+    df_scores= pd.DataFrame(Z, columns=regions)
+    df_scores.insert(0, df.columns[0], ids)
+
+    return df_resid, df_scores, unmatched[unmatched['missing from']=='participants']
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Score new subjects against the models of the control group saved in an '
+                                                'output directory without combining, correcting, or fitting again',
+                                    formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-i', '--input', required=True,
+                        help='a csv file containing region based statistics of new subjects, first column is subject ids')
+    parser.add_argument('-p', '--participants', required=True, help='a csv file containing demographic info of the subjects')
+    parser.add_argument('-o', '--output', required=True,
+                        help='a directory analyzed with demographics by the web application, batch.py, '
+                             'demography-effect.py, or correct_for_demography.py')
+    parser.add_argument('-d', '--delimiter', default='comma', help='delimiter used between measures in the --input '
+                                                                   '{comma,tab,space,semicolon}, default: %(default)s, '
+                                                                   'same delimiter must be used for both -i and -p')
+    parser.add_argument('-t', '--table', help='name of the analyzed table whose models are used e.g. asegstats, '
+                                              'default: the one analyzed last')
+    parser.add_argument('-x', '--extent', type=float, default=2, help='acceptable zscore, default: %(default)s')
+    parser.add_argument('-r', '--reference', choices=REFERENCES, default='cohort',
+                        help='standardize against residuals of all analyzed subjects like zscores.csv and watch.py, '
+                             'or of the control group, default: %(default)s')
+    parser.add_argument('-s', '--save', help='a csv file where standard scores are saved')
+
+    args= parser.parse_args()
+    outDir= abspath(args.output)
+
+    df= read_table(abspath(args.input), delimiter_dict[args.delimiter], converters={0: str})
+    df_demograph= read_table(abspath(args.participants), delimiter_dict[args.delimiter], converters={0: str})
+    df_resid, df_scores, unmatched= score_subjects(outDir, df, df_demograph, args.table, args.reference)
+
+    print('Standardized against residuals of', 'the analyzed subjects' if args.reference=='cohort' else 'the control group')
+    if len(unmatched):
+        print('Subjects without demographic info are not scored:', ', '.join(unmatched['subject'].astype(str)))
+    print(summarize(df_scores, args.extent, 'subjects').to_string(index=False))
+    if args.save:
+        write_table(df_scores, abspath(args.save))
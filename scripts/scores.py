@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+from scipy.spatial.distance import mahalanobis
+from scipy.stats import scoreatpercentile
+from sklearn.ensemble import IsolationForest
+import pandas as pd
+import numpy as np
+
+CONTAMIN=.05
+
+
+def standardize(X):
+    '''
+    :param X: subjects x regions array
+    :return: standard scores of each column rounded to 4 decimals, columns with zero standard deviation get zero scores
+    '''
+
+    X= np.asarray(X, dtype=float)
+    val_mean= X.mean(axis=0)
+    val_std= X.std(axis=0)
+    nonzero= val_std>0
+    Z= np.zeros(X.shape)
+    Z[:, nonzero]= np.round((X[:, nonzero]-val_mean[nonzero])/val_std[nonzero], 4)
+
+    return Z
+
+
+def zscores(df):
+    '''
+    :param df: subjects x regions table, first column is subject ids
+    :return: a copy of df with standard scores of each region, see standardize()
+    '''
+
+    df_scores= df.copy()
+    regions= df.columns[1:]
+    df_scores[regions]= standardize(df[regions].values)
+
+    return df_scores
+
+
+def summarize(df, extent, group_by='subjects'):
+    '''
+    :param df: zscores() output
+    :param group_by: subjects or regions
+    :return: summary table of outliers beyond extent, grouped by subjects or regions
+    '''
+
+    subjects= df[df.columns[0]].values
+    regions= df.columns.values[1:]
+    outliers= abs(df[regions].values.astype(float)) > extent
+
+    if group_by=='subjects':
+        dfs = pd.DataFrame(columns=['Subject ID', '# of outliers', 'outliers'])
+        for i in range(len(df)):
+            dfs.loc[i]=[subjects[i], int(outliers[i].sum()), '\n'.join([x for x in regions[outliers[i]]])]
+
+    else:
+        dfs = pd.DataFrame(columns=['Regions', '# of outliers', 'outliers'])
+        for i,region in enumerate(regions):
+            dfs.loc[i] = [region, int(outliers[:,i].sum()), '\n'.join([str(x) for x in subjects[outliers[:,i]]])]
+
+    return dfs
+
+
+def multivariate(df, method='isf', PERCENT_LOW=None, PERCENT_HIGH=None):
+    '''
+    :param df: subjects x regions table, first column is subject ids
+    :param method: md for Mahalonobis distance or isf for Isolation Forest
+    :return: summary table of subjects with their scores and outlier flags
+    '''
+
+    regions = df.columns.values[1:]
+    subjects = df[df.columns[0]].values
+    L= len(subjects)
+
+    columns= ['Subjects', 'Mahalonobis/IsoForest', 'Outlier']
+    multiv_summary= pd.DataFrame(columns=columns)
+
+    X= df[regions].values.astype(float)
+    meanX= np.mean(X, axis=0)
+    ind= np.where(meanX==0)
+
+    X= np.delete(X, ind, axis=1)
+    meanX= np.delete(meanX, ind)
+
+    if method=='md':
+        PERCENT_LOW= int(PERCENT_LOW) if PERCENT_LOW else 0
+        PERCENT_HIGH = int(PERCENT_HIGH) if PERCENT_HIGH else 80
+        # Mahalanobis distance block =================================
+        # Normalizing to avoid md^2 < 0
+        X = X / np.max(X, axis=0)
+        covX= np.cov(X, rowvar= False)
+        icovX= np.linalg.inv(covX)
+        MD= np.zeros((L,))
+        for i in range(L):
+            x= X[i,: ]
+            MD[i]= mahalanobis(x, meanX, icovX)
+
+        measure= MD
+
+        # ENH could be done according to Chi2 probability, see draft/md_chi2_analysis.py
+
+    elif method=='isf':
+        PERCENT_LOW= int(PERCENT_LOW) if PERCENT_LOW else 3
+        PERCENT_HIGH = int(PERCENT_HIGH) if PERCENT_HIGH else 97
+        # IsolationForest block =================================
+        rng = np.random.RandomState(123456)
+        num_samples = len(subjects)
+        iso_f = IsolationForest(max_samples=num_samples,
+                                contamination=CONTAMIN,
+                                random_state=rng)
+        iso_f.fit(df[regions])
+        pred_scores = iso_f.decision_function(df[regions])
+
+        measure= pred_scores
+
+
+    # Decision block
+    h_thresh= scoreatpercentile(measure, PERCENT_HIGH)
+    l_thresh = scoreatpercentile(measure, PERCENT_LOW)
+    inliers= np.logical_and(measure <= h_thresh, measure >= l_thresh)
+
+    for i in range(L):
+        multiv_summary.loc[i] = [subjects[i], round(measure[i], 3), '' if inliers[i] else 'X']
+
+    return multiv_summary
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import argparse
+from os import cpu_count, makedirs, environ
+from os.path import isdir, isfile, abspath, join as pjoin
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from util import table_name, read_table, write_table
+from stats_reader import make_table
+from scan_subjects import subjects_index
+from fs_archive import exists, load_mgh
+from view_roi import load_lut
+
+SEGMENTATIONS= ['aseg', 'aparc+aseg']
+TOLERANCE= .05
+
+
+def lut_names(lut):
+    '''
+    :param lut: load_lut() output
+    :return: {label: name}
+    '''
+
+    return {int(row[0]): row[1] for row in lut}
+
+
+def label_volumes(fsdir, seg='aseg'):
+    '''
+    Count voxels of every label of mri/{seg}.mgz in one bincount pass
+    :return: {label: volume in mm^3}, None if the segmentation does not exist
+    '''
+
+    seg_mgh= pjoin(fsdir, 'mri', f'{seg}.mgz')
+    if not exists(seg_mgh):
+        return None
+
+    img= load_mgh(seg_mgh)
+    labels= np.asarray(img.dataobj).ravel().astype(np.intp, copy=False)
+    counts= np.bincount(labels[labels>0])
+    voxel_volume= float(np.prod(img.header.get_zooms()[:3]))
+
+    return {label: counts[label]*voxel_volume for label in np.flatnonzero(counts)}
+
+
+def read_volumes(fsdirs, seg='aseg', ncpu=None):
+    '''
+    :return: label_volumes() output for each freesurfer directory
+    '''
+
+    ncpu= ncpu or cpu_count()
+    chunksize= max(1, len(fsdirs)//(4*ncpu))
+
+    with ProcessPoolExecutor(max_workers=ncpu) as executor:
+        return list(executor.map(label_volumes, fsdirs, [seg]*len(fsdirs), chunksize=chunksize))
+
+
+def volumes_table(cases, volumes, names):
+    '''
+    :param volumes: read_volumes() output for each subject id
+    :param names: lut_names() output, labels missing from the LUT are named by their number
+    :return: subject x region table like asegstats2table output, regions are in the order of labels
+    '''
+
+    labels= sorted(set().union(*[v for v in volumes if v]))
+    rows= [{names.get(l, str(l)): v.get(l, 0) for l in labels} if v else None for v in volumes]
+
+    return make_table(cases, rows, 'Measure:volume')
+
+
+def crosscheck(df_seg, df_stats):
+    '''
+    :return: relative difference of segmentation derived volumes from stats derived volumes,
+        for subjects and regions common to both tables
+    '''
+
+    seg_id, stats_id= df_seg.columns[0], df_stats.columns[0]
+    regions= [r for r in df_seg.columns[1:] if r in df_stats.columns[1:]]
+
+    df_seg= df_seg.set_index(df_seg[seg_id].astype(str))[regions]
+    df_stats= df_stats.set_index(df_stats[stats_id].astype(str))[regions]
+    subjects= [s for s in df_seg.index if s in df_stats.index]
+
+    df= ((df_seg.loc[subjects]- df_stats.loc[subjects])/df_stats.loc[subjects].replace(0, np.nan)).round(4)
+    df.insert(0, seg_id, subjects)
+
+    return df.reset_index(drop=True)
+
+
+def seg_volumes(caselist, template, outDir, lut, seg='aseg', ncpu=None, stats=None, tolerance=TOLERANCE):
+    '''
+    Write {seg}_volumes table in outDir, and {seg}_volumes_crosscheck table if stats table is provided
+    '''
+
+    cases= None
+    if caselist:
+        with open(caselist) as f:
+            cases= f.read().split()
+
+    # freesurfer directories are checked once and indexed in outDir, see scan_subjects.py
+    index= subjects_index(template, outDir, cases)
+    # the index records mri/aseg.mgz only, other segmentations are checked here
+    if seg=='aseg':
+        index= index[index['aseg']]
+    else:
+        index= index[[exists(pjoin(fsdir, 'mri', f'{seg}.mgz')) for fsdir in index['fsdir']]]
+    cases= index['subject'].tolist()
+
+    volumes= read_volumes(index['fsdir'].tolist(), seg, ncpu)
+    df= volumes_table(cases, volumes, lut_names(load_lut(lut)))
+    write_table(df, table_name(pjoin(outDir, f'{seg}_volumes')))
+
+    if stats:
+        df_diff= crosscheck(df, read_table(stats, converters={0: str}))
+        write_table(df_diff, table_name(pjoin(outDir, f'{seg}_volumes_crosscheck')))
+        num_diff= int((abs(df_diff[df_diff.columns[1:]])>tolerance).sum().sum())
+        print(f'{num_diff} subject-region volumes differ from {stats} by more than {tolerance:.0%}')
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Compute regional volumes from mri/aseg.mgz or mri/aparc+aseg.mgz '
+                                                'of freesurfer directories counting voxels of each label, '
+                                                'and optionally cross-check them against a stats table')
+
+    parser.add_argument('-t', '--template', required=True,
+                        help='freesurfer directory pattern enclosed in double quotes e.g. '
+                             '"/path/to/derivatives/pnlpipe/sub-*/anat/freesurfer", '
+                             'where * is the placeholder for subject id')
+    parser.add_argument('-c', '--caselist', help='subject ids, discovered from --template if not provided')
+    parser.add_argument('-o', '--output', required=True, help='a directory where the tables are saved')
+    parser.add_argument('-s', '--seg', default='aseg', choices=SEGMENTATIONS,
+                        help='segmentation to count labels in, default: %(default)s')
+    parser.add_argument('-l', '--lut', help='FreeSurferColorLUT.txt to name labels, '
+                                            'default: $FREESURFER_HOME/FreeSurferColorLUT.txt')
+    parser.add_argument('-n', '--ncpu', type=int, default=None, help='number of processes, default: number of cores')
+    parser.add_argument('--stats', help='a stats2table.py output e.g. output/asegstats.csv to cross-check against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='relative difference reported by cross-check, default: %(default)s')
+
+    args= parser.parse_args()
+    outDir= abspath(args.output)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
+
+    lut= args.lut or pjoin(environ.get('FREESURFER_HOME', ''), 'FreeSurferColorLUT.txt')
+    if not isfile(lut):
+        parser.error(f'{lut} does not exist, provide --lut')
+
+    seg_volumes(abspath(args.caselist) if args.caselist else None, args.template, outDir, lut, args.seg, args.ncpu,
+                args.stats, args.tolerance)
@@ -15,6 +15,8 @@ from subprocess import check_call
 import logging
 
 from verify_ports import get_ports
+from util import read_table
+from scan_subjects import lookup
 table_port= get_ports('table_port')
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -36,7 +38,7 @@ if __name__ == '__main__':
                         'values beyond e\'th percentile are outliers, if e>70; default %(default)s')
 
     args= parser.parse_args()
-    df= pd.read_csv(abspath(args.input))
+    df= read_table(abspath(args.input))
     subjects= df[df.columns[0]].values
     # df = pd.read_csv('C://Users/tashr/Documents/fs-stats-aparc/outliers.csv')
 
@@ -126,8 +128,8 @@ if __name__ == '__main__':
             if not args.template:
                 return
             # nilearn or freeview rendering
-            fsdir = args.template.replace('sub-*/', 'sub-{}/'.format(subjects[temp['row']]))
-            if isdir(fsdir):
+            fsdir = lookup(args.template, subjects[temp['row']], dirname(abspath(args.input)))
+            if fsdir:
                 check_call(' '.join(['python', pjoin(dirname(abspath(__file__)), 'view_roi.py'), '-o', dirname(args.input),
                                      '-i', fsdir, '-l', temp['column_id'], '-v', view_type]), shell=True)
 
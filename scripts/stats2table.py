@@ -1,64 +1,181 @@
 #!/usr/bin/env python
 
-from tempfile import TemporaryDirectory, mkdtemp
-from os.path import isdir, join as pjoin, abspath
-from os import symlink, makedirs, environ
-from subprocess import check_call, Popen
+from tempfile import mkdtemp
+from os.path import isdir, isfile, join as pjoin, abspath
+from os import symlink, makedirs, environ, cpu_count
+from subprocess import check_call
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
 import argparse
 from shutil import rmtree
+import pandas as pd
 
-def stats2table(caselist, template, outDir, measure='volume', delimiter='comma', parc='aparc'):
+from util import delimiter_dict, table_name, read_table, write_table
+from stats_reader import read_cohort, cohort_tables, covariates_table, load_cache, save_cache
+from scan_subjects import subjects_index
 
-    tmpdir= mkdtemp()
+
+def read_caselist(caselist):
 
     with open(caselist) as f:
         cases= [c.strip() for c in f.read().strip().split()]
 
-    for c in cases:
-        fsdir = template.replace('*', c)
-        if isdir(fsdir):
-            symlink(fsdir, pjoin(tmpdir, c))
+    return cases
+
+
+def stats_prefix(hemi, parc, measure, suffix):
+
+    name= 'asegstats' if hemi=='aseg' else f'aparcstats_{hemi}'
+    if suffix:
+        # more than one measure or parcellation extracted together
+        name+= f'_{measure}' if hemi=='aseg' else f'_{parc}_{measure}'
+
+    return name
+
+
+def stats2table(caselist, template, outDir, measure='volume', delimiter='comma', parc='aparc', ncpu=None,
+                incremental=False):
+    '''
+    :param caselist: a text file with subject ids, subjects are discovered from template if not provided
+    :param measure: a measure or a list of them
+    :param parc: a parcellation or a list of them
+    '''
+
+    measures= measure.split(',') if isinstance(measure, str) else measure
+    parcs= parc.split(',') if isinstance(parc, str) else parc
+
+    # freesurfer directories are checked once and indexed in outDir, see scan_subjects.py
+    index= subjects_index(template, outDir, read_caselist(caselist) if caselist else None)
+    index= index[index['stats']]
+    cases= index['subject'].tolist()
+    fsdirs= index['fsdir'].tolist()
+
+    if incremental:
+        # parsed stats of earlier runs are kept in outDir keyed by stats file path, mtime, and size
+        cache_file= pjoin(outDir, '.stats_cache.pkl')
+        cache= load_cache(cache_file)
+        subjects= read_cohort(fsdirs, parcs, ncpu, cache)
+        save_cache(cache, cache_file)
+    else:
+        subjects= read_cohort(fsdirs, parcs, ncpu)
+
+    suffix= len(measures)>1 or len(parcs)>1
+    tables= cohort_tables(cases, subjects, measures, parcs)
+    for (hemi, parc, measure), df in tables.items():
+        write_table(df, table_name(pjoin(outDir, stats_prefix(hemi, parc, measure, suffix))), delimiter_dict[delimiter])
+
+    write_table(covariates_table(cases, subjects), table_name(pjoin(outDir, 'covariates')), delimiter_dict[delimiter])
+
+
+def fs_stats2table(caselist, template, outDir, measure='volume', delimiter='comma', parc='aparc', ncpu=None,
+                   shard_size=None):
+    '''
+    Split caselist into shards, run aparcstats2table for lh and rh, and asegstats2table on all shards concurrently,
+    and merge partial tables in the order of subjects in caselist
+    '''
+
+    # shard valid subjects only so that no FreeSurfer command is left without a subject
+    cases= [c for c in read_caselist(caselist) if isdir(template.replace('*', c))]
+    if not cases:
+        raise ValueError(f'no subject of {caselist} has a freesurfer directory like {template}')
+
+    ncpu= ncpu or cpu_count()
+    shard_size= max(1, shard_size or ceil(len(cases)/ncpu))
+    shards= [cases[i:i+shard_size] for i in range(0, len(cases), shard_size)]
+
+    tmpdir= mkdtemp()
+    shardir= mkdtemp()
+    try:
+        for c in cases:
+            symlink(template.replace('*', c), pjoin(tmpdir, c))
+
+        fsbin= environ['FREESURFER_HOME']+ '/bin'
+        modified_env= environ.copy()
+        modified_env['SUBJECTS_DIR']= tmpdir
+
+        cmds= []
+        partials= {'aparcstats_lh': [], 'aparcstats_rh': [], 'asegstats': []}
+        for i, shard in enumerate(shards):
+            shardlist= pjoin(shardir, f'caselist_{i}.txt')
+            with open(shardlist, 'w') as f:
+                f.write('\n'.join(shard))
+
+            for hemi in ['lh', 'rh']:
+                partial= pjoin(shardir, f'aparcstats_{hemi}_{i}.csv')
+                cmds.append(f'{fsbin}/aparcstats2table --subjectsfile={shardlist} --hemi={hemi} -m {measure} '
+                            f'-d {delimiter} --skip -t {partial} --parc {parc}')
+                partials[f'aparcstats_{hemi}'].append(partial)
+
+            partial= pjoin(shardir, f'asegstats_{i}.csv')
+            cmds.append(f'{fsbin}/asegstats2table --subjectsfile={shardlist} -m {measure} -d {delimiter} '
+                        f'--skip -t {partial}')
+            partials['asegstats'].append(partial)
 
-    fsbin= environ['FREESURFER_HOME']+ '/bin'
-    modified_env= environ.copy()
-    modified_env['SUBJECTS_DIR']= tmpdir
-    for hemi in ['lh', 'rh']:
-        cmd = f'{fsbin}/aparcstats2table --subjectsfile={caselist} --hemi={hemi} -m {measure} -d {delimiter} ' \
-              f'--skip -t {outDir}/aparcstats_{hemi}.csv --parc {parc}'
-        check_call(cmd, shell=True, env=modified_env)
+        with ThreadPoolExecutor(max_workers=ncpu) as executor:
+            list(executor.map(lambda cmd: check_call(cmd, shell=True, env=modified_env), cmds))
 
+        # shards are in the order of caselist, so are the merged tables
+        sep= delimiter_dict[delimiter]
+        for name, files in partials.items():
+            files= [f for f in files if isfile(f)]
+            if not files:
+                raise ValueError(f'{name} of no subject could be read, see the FreeSurfer output above')
+            df= pd.concat([read_table(f, sep) for f in files], ignore_index=True).fillna(0)
+            write_table(df, table_name(pjoin(outDir, name)), sep)
 
-    cmd = f'{fsbin}/asegstats2table --subjectsfile={caselist} -m {measure} -d {delimiter} ' \
-          f'--skip -t {outDir}/asegstats.csv'
-    check_call(cmd, shell=True, env=modified_env)
-    
-    rmtree(tmpdir)
+    finally:
+        rmtree(tmpdir)
+        rmtree(shardir)
 
 
 if __name__== '__main__':
     parser= argparse.ArgumentParser(
-        description='Make symbolic links of freesurfer directories in one place and generate {aseg,aparc}stats2table')
+        description='Parse stats/{aseg,?h.aparc}.stats of freesurfer directories and generate '
+                    '{aseg,aparc}stats2table like tables')
 
     parser.add_argument('-c', '--caselist', required=False,
-                        help='subject ids from the caselist are used in template to obtain valid freesurfer directory')
-    parser.add_argument('-t', '--template', required=False,
+                        help='subject ids from the caselist are used in template to obtain valid freesurfer directory, '
+                             'subjects are discovered from --template if not provided')
+    parser.add_argument('-t', '--template', required=True,
                         help='freesurfer directory pattern enclosed in double quotes e.g. '
                              '"/path/to/*/freesurfer" or "/path/to/derivatives/pnlpipe/sub-*/anat/freesurfer", '
-                             'where * is the placeholder for subject id')
+                             'where * is the placeholder for subject id, subject archives are read in place e.g. '
+                             '"/path/to/archives/sub-*.tar.gz/freesurfer"')
     parser.add_argument('-o', '--output', required=True, help='a directory where outlier analysis results are saved')
     parser.add_argument('-p', '--parc', default='aparc',
-                        help='parcellation stats to use with aparcstats2table (alternative is aparc.a2009s)')
+                        help='parcellation stats to use with aparcstats2table (alternative is aparc.a2009s), '
+                             'the built-in parser accepts a comma separated list e.g. aparc,aparc.a2009s,aparc.DKTatlas')
     parser.add_argument('-d', '--delimiter', default='comma', help='delimiter to use between measures in the output table '
                                                                    '{comma,tab,space,semicolon}, default: %(default)s')
 
     parser.add_argument('-m', '--measure', default='volume',
                         help='measure extracted from stats/{asegstats,aparcstats_{lh,rh}}.tsv files, default: %(default)s. '
-                             'See `asegstats2table -h` and `aparcstats2table -h` for supported measures')
+                             'See `asegstats2table -h` and `aparcstats2table -h` for supported measures. '
+                             'The built-in parser accepts a comma separated list e.g. volume,thickness,area,meancurv '
+                             'and extracts all of them opening each stats file once')
+    parser.add_argument('-n', '--ncpu', type=int, default=None,
+                        help='number of processes for parsing stats files, or number of concurrent FreeSurfer '
+                             'commands with --freesurfer, default: number of cores')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep parsed stats in output/.stats_cache.pkl and parse only new or changed subjects '
+                             'in subsequent runs')
+    parser.add_argument('--freesurfer', action='store_true',
+                        help='use FreeSurfer asegstats2table and aparcstats2table instead of the built-in parser, '
+                             'requires FREESURFER_HOME')
+    parser.add_argument('--shard-size', type=int, default=None,
+                        help='number of subjects per FreeSurfer command with --freesurfer, the caselist is split into '
+                             'shards that are run concurrently, default: number of subjects / ncpu')
 
     args= parser.parse_args()
     outDir= abspath(args.output)
     if not isdir(outDir):
         makedirs(outDir, exist_ok= True)
-    
-    stats2table(abspath(args.caselist), args.template, outDir, args.measure, args.delimiter, args.parc)
 
+    if args.freesurfer:
+        if not args.caselist:
+            parser.error('--caselist is required with --freesurfer')
+        fs_stats2table(abspath(args.caselist), args.template, outDir, args.measure, args.delimiter, args.parc,
+                       args.ncpu, args.shard_size)
+    else:
+        stats2table(abspath(args.caselist) if args.caselist else None, args.template, outDir, args.measure, args.delimiter, args.parc, args.ncpu,
+                    args.incremental)
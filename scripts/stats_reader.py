@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+from os.path import isfile, join as pjoin
+from os import cpu_count
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+from fs_archive import read_many, stamp as file_stamp
+
+# measure accepted by asegstats2table/aparcstats2table --> column in ColHeaders of stats/*.stats
+ASEG_MEASURES= {'volume': 'Volume_mm3',
+                'mean': 'normMean',
+                'std': 'normStdDev'}
+
+APARC_MEASURES= {'area': 'SurfArea',
+                 'volume': 'GrayVol',
+                 'thickness': 'ThickAvg',
+                 'thicknessstd': 'ThickStd',
+                 'meancurv': 'MeanCurv',
+                 'gauscurv': 'GausCurv',
+                 'foldind': 'FoldInd',
+                 'curvind': 'CurvInd'}
+
+# whole hemisphere measures appended by aparcstats2table
+APARC_HEMI_MEASURES= {'thickness': 'MeanThickness',
+                      'area': 'WhiteSurfArea'}
+APARC_GLOBAL_MEASURES= ['BrainSegVolNotVent', 'eTIV']
+# asegstats2table spells out eTIV
+ASEG_GLOBAL_RENAME= {'eTIV': 'EstimatedTotalIntraCranialVol'}
+
+# global measures of aseg.stats header exported as covariates
+COVARIATES= ['eTIV', 'BrainSegVol', 'SurfaceHoles']
+
+
+def parse_stats(content):
+    '''
+    :param content: text of a FreeSurfer stats/*.stats file
+    :return: dict with
+        'measures': [(name, short name, value)] from the '# Measure' lines
+        'structs': {StructName: {column: value}} from the table under '# ColHeaders'
+    '''
+
+    measures= []
+    structs= {}
+    header= None
+    for line in content.split('\n'):
+        if line.startswith('# Measure'):
+            # e.g. # Measure EstimatedTotalIntraCranialVol, eTIV, Estimated Total Intracranial Volume, 1.5e+06, mm^3
+            fields= [x.strip() for x in line[len('# Measure'):].split(',')]
+            try:
+                measures.append((fields[0], fields[1], float(fields[3])))
+            except (IndexError, ValueError):
+                continue
+        elif line.startswith('# ColHeaders'):
+            header= line.split()[2:]
+        elif header and line.strip() and not line.startswith('#'):
+            values= line.split()
+            row= {}
+            for col, val in zip(header, values):
+                try:
+                    row[col]= float(val)
+                except ValueError:
+                    row[col]= val
+            structs[row['StructName']]= row
+
+    return {'measures': measures, 'structs': structs}
+
+
+def as_list(x):
+
+    return [x] if isinstance(x, str) else list(x)
+
+
+def stats_files(fsdir, parcs='aparc'):
+    '''
+    :param parcs: one or more parcellations e.g. ['aparc', 'aparc.a2009s', 'aparc.DKTatlas']
+    :return: {key: stats file}, key is aseg or {hemi}.{parc}
+    '''
+
+    files= {'aseg': pjoin(fsdir, 'stats', 'aseg.stats')}
+    for parc in as_list(parcs):
+        for hemi in ['lh', 'rh']:
+            files[f'{hemi}.{parc}']= pjoin(fsdir, 'stats', f'{hemi}.{parc}.stats')
+
+    return files
+
+
+def read_files(files):
+    '''
+    :param files: {key: stats file}, stats files may be within .tar.gz or .zip archives of subjects
+    :return: {key: parse_stats() output}, missing files are returned as None
+    '''
+
+    contents= read_many(files.values())
+
+    return {key: parse_stats(contents[filename].decode()) if contents[filename] is not None else None
+            for key, filename in files.items()}
+
+
+def read_changed(files, stamps):
+    '''
+    :param files: {key: stats file}
+    :param stamps: {stats file: (mtime, size)} of files parsed earlier
+    :return: {stats file: ((mtime, size), parse_stats() output)} for new or changed files only
+    '''
+
+    # stats files within an archive are stamped with the archive
+    current= {filename: file_stamp(filename) for filename in files.values()}
+    todo= {filename: filename for filename, stamp in current.items()
+           if not (filename in stamps and stamps[filename]==stamp)}
+    parsed= read_files(todo)
+
+    return {filename: (current[filename], parsed[filename]) for filename in todo}
+
+
+def load_cache(filename):
+
+    if not isfile(filename):
+        return {}
+
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_cache(cache, filename):
+
+    with open(filename, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def aseg_row(stats, measure):
+
+    col= ASEG_MEASURES[measure]
+    row= {name: s[col] for name, s in stats['structs'].items()}
+    if measure=='volume':
+        for _, name, value in stats['measures']:
+            row[ASEG_GLOBAL_RENAME.get(name, name)]= value
+
+    return row
+
+
+def aparc_row(stats, hemi, measure):
+
+    col= APARC_MEASURES[measure]
+    row= {f'{hemi}_{name}_{measure}': s[col] for name, s in stats['structs'].items()}
+
+    measures= {short: value for _, short, value in stats['measures']}
+    if measure in APARC_HEMI_MEASURES:
+        name= APARC_HEMI_MEASURES[measure]
+        if name in measures:
+            row[f'{hemi}_{name}_{measure}']= measures[name]
+    for name in APARC_GLOBAL_MEASURES:
+        if name in measures:
+            row[name]= measures[name]
+
+    return row
+
+
+def covariates_row(stats):
+
+    measures= {short: value for _, short, value in stats['measures']}
+
+    return {name: measures.get(name) for name in COVARIATES}
+
+
+def make_table(cases, rows, id_col_hdr, fill=0):
+    '''
+    Assemble subject x region table, subjects without stats are skipped (as in --skip of FreeSurfer)
+    and regions missing for a subject are filled with 0 (as in aparcstats2table)
+    '''
+
+    ids= [c for c, r in zip(cases, rows) if r is not None]
+    df= pd.DataFrame([r for r in rows if r is not None])
+    if fill is not None:
+        df= df.fillna(fill)
+    df.insert(0, id_col_hdr, ids)
+
+    return df
+
+
+def read_cohort(fsdirs, parcs='aparc', ncpu=None, cache=None):
+    '''
+    Each stats file of a subject is opened once irrespective of the number of measures extracted from it
+    :param fsdirs: freesurfer directories
+    :param cache: {stats file: ((mtime, size), parse_stats() output)} of earlier runs, updated in place and pruned
+        to the stats files of fsdirs, if provided, only new or changed stats files are parsed
+    :return: read_files() output of stats_files() of each freesurfer directory, missing files are returned as None
+    '''
+
+    ncpu= ncpu or cpu_count()
+    chunksize= max(1, len(fsdirs)//(4*ncpu))
+    files= [stats_files(fsdir, parcs) for fsdir in fsdirs]
+
+    with ProcessPoolExecutor(max_workers=ncpu) as executor:
+        if cache is None:
+            return list(executor.map(read_files, files, chunksize=chunksize))
+
+        stamps= [{f: cache[f][0] for f in subject_files.values() if f in cache} for subject_files in files]
+        updates= list(executor.map(read_changed, files, stamps, chunksize=chunksize))
+
+    num_changed= 0
+    subjects= []
+    for subject_files, update in zip(files, updates):
+        num_changed+= bool(update)
+        cache.update(update)
+        subjects.append({key: cache[f][1] for key, f in subject_files.items()})
+
+    # stats files of subjects no longer in the cohort are dropped so that the cache does not grow across runs
+    current= {f for subject_files in files for f in subject_files.values()}
+    for f in set(cache)- current:
+        del cache[f]
+
+    print(f'Parsed stats of {num_changed} new or changed subjects, '
+          f'reused {len(fsdirs)-num_changed} subjects from cache')
+
+    return subjects
+
+
+def cohort_tables(cases, subjects, measures='volume', parcs='aparc'):
+    '''
+    :param cases: subject ids
+    :param subjects: read_cohort() output for each subject id
+    :param measures: one or more measures e.g. ['volume', 'thickness', 'area', 'meancurv']
+    :param parcs: one or more parcellations
+    :return: {(hemi, parc, measure): df} for each valid combination, hemi is aseg, lh, or rh and parc is None for aseg,
+        tables are keyed like asegstats2table/aparcstats2table output
+    '''
+
+    tables= {}
+    for measure in as_list(measures):
+        if measure in ASEG_MEASURES:
+            rows= [aseg_row(s['aseg'], measure) if s['aseg'] else None for s in subjects]
+            tables[('aseg', None, measure)]= make_table(cases, rows, f'Measure:{measure}')
+
+        if measure in APARC_MEASURES:
+            for parc in as_list(parcs):
+                for hemi in ['lh', 'rh']:
+                    key= f'{hemi}.{parc}'
+                    rows= [aparc_row(s[key], hemi, measure) if s[key] else None for s in subjects]
+                    tables[(hemi, parc, measure)]= make_table(cases, rows, f'{hemi}.{parc}.{measure}')
+
+    return tables
+
+
+def covariates_table(cases, subjects):
+    '''
+    :return: subject x [eTIV, BrainSegVol, SurfaceHoles] table from aseg.stats header,
+        to be appended to demographic info as covariates
+    '''
+
+    rows= [covariates_row(s['aseg']) if s['aseg'] else None for s in subjects]
+
+    return make_table(cases, rows, 'subject', fill=None)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import argparse
+from os import makedirs
+from os.path import isdir, abspath, join as pjoin
+import numpy as np
+import pandas as pd
+
+from util import write_table
+
+AGE_RANGE= (20, 80)
+VOLUME_SHAPE= (32, 32, 32)
+
+ASEG_HEADER= '''# Title Segmentation Statistics
+# generating_program synthetic_cohort.py
+# Measure BrainSeg, BrainSegVol, Brain Segmentation Volume, {brainseg:.1f}, mm^3
+# Measure BrainSegNotVent, BrainSegVolNotVent, Brain Segmentation Volume Without Ventricles, {brainseg:.1f}, mm^3
+# Measure EstimatedTotalIntraCranialVol, eTIV, Estimated Total Intracranial Volume, {etiv:.1f}, mm^3
+# Measure SurfaceHoles, SurfaceHoles, Total number of defect holes in surfaces prior to fixing, {holes}, unitless
+# ColHeaders  Index SegId NVoxels Volume_mm3 StructName normMean normStdDev normMin normMax normRange
+'''
+
+APARC_HEADER= '''# Title Cortical Parcellation Statistics
+# generating_program synthetic_cohort.py
+# Measure Cortex, NumVert, Number of Vertices, 120000, unitless
+# Measure Cortex, WhiteSurfArea, White Surface Total Area, 80000.0, mm^2
+# Measure Cortex, MeanThickness, Mean Thickness, {thickness:.5f}, mm
+# Measure BrainSeg, BrainSegVolNotVent, Brain Segmentation Volume Without Ventricles, {brainseg:.1f}, mm^3
+# Measure EstimatedTotalIntraCranialVol, eTIV, Estimated Total Intracranial Volume, {etiv:.1f}, mm^3
+# ColHeaders StructName NumVert SurfArea GrayVol ThickAvg ThickStd MeanCurv GausCurv FoldInd CurvInd
+'''
+
+
+def region_names(num_regions):
+
+    return [f'Region-{i+1}' for i in range(num_regions)]
+
+
+def write_lut(filename, num_regions, seed=0):
+    '''
+    Write a FreeSurferColorLUT.txt like file for the synthetic regions, label i is Region-i
+    '''
+
+    rng= np.random.default_rng(seed)
+    with open(filename, 'w') as f:
+        f.write('#No. Label Name:                            R   G   B   A\n')
+        f.write('0   Unknown                                 0   0   0   0\n')
+        for i, name in enumerate(region_names(num_regions)):
+            r, g, b= rng.integers(0, 256, 3)
+            f.write(f'{i+1:<4}{name:<40}{r:<4}{g:<4}{b:<4}0\n')
+
+
+def write_aseg_stats(filename, names, volumes, brainseg, etiv, holes):
+
+    with open(filename, 'w') as f:
+        f.write(ASEG_HEADER.format(brainseg=brainseg, etiv=etiv, holes=holes))
+        for i, (name, vol) in enumerate(zip(names, volumes)):
+            f.write(f'{i+1:3d} {i+1:4d} {int(vol):8d} {vol:10.1f}  {name:<32} '
+                    f'80.0000 10.0000 40.0000 120.0000 80.0000\n')
+
+
+def write_aparc_stats(filename, names, grayvols, thickness, brainseg, etiv):
+
+    with open(filename, 'w') as f:
+        f.write(APARC_HEADER.format(thickness=thickness.mean(), brainseg=brainseg, etiv=etiv))
+        for name, vol, thick in zip(names, grayvols, thickness):
+            f.write(f'{name:<32} {int(vol/2.5):6d} {vol/2.5:6.0f} {vol:6.0f} {thick:5.3f} 0.600 '
+                    f'0.120 0.020 10 1.0\n')
+
+
+def write_volumes(fsdir, num_regions, rng):
+    '''
+    Write small mri/aseg.mgz, mri/aparc+aseg.mgz, and mri/brain.mgz with random blocks of region labels
+    '''
+
+    from nibabel.freesurfer import MGHImage
+
+    shape= VOLUME_SHAPE
+    labels= rng.integers(0, num_regions+1, (4, 4, 4)).astype(np.int32)
+    seg= np.kron(labels, np.ones([s//4 for s in shape], dtype=np.int32))
+    brain= (seg>0)*rng.integers(60, 120, shape).astype(np.uint8)
+    affine= np.diag([1., 1., 1., 1.])
+
+    MGHImage(seg, affine).to_filename(pjoin(fsdir, 'mri', 'aseg.mgz'))
+    MGHImage(seg, affine).to_filename(pjoin(fsdir, 'mri', 'aparc+aseg.mgz'))
+    MGHImage(brain, affine).to_filename(pjoin(fsdir, 'mri', 'brain.mgz'))
+
+
+def make_cohort(outDir, num_subjects, num_regions, num_volumes=1, fstree=True, seed=0):
+    '''
+    Generate a synthetic cohort of num_subjects x num_regions in outDir:
+        regions.csv: subject x region table with an age effect on every region
+        participants.csv: subject, age, sex, group; group==1 is the control group
+        FreeSurferColorLUT.txt: color table of the regions
+        sub-*/freesurfer: stats/aseg.stats, stats/{lh,rh}.aparc.stats, and scripts/recon-all.done of each subject,
+            and small mri/{aseg,aparc+aseg,brain}.mgz of the first num_volumes subjects
+    :return: freesurfer directory template
+    '''
+
+    rng= np.random.default_rng(seed)
+    subjects= [f'{i+1:05d}' for i in range(num_subjects)]
+    names= region_names(num_regions)
+
+    age= rng.uniform(*AGE_RANGE, num_subjects).round(1)
+    sex= rng.choice(['M', 'F'], num_subjects)
+    group= rng.choice([1, 2], num_subjects)
+
+    # volume = intercept + slope*age + noise, a few subjects are made outliers
+    intercept= rng.uniform(1000, 20000, num_regions)
+    slope= rng.uniform(-0.005, 0.005, num_regions)*intercept
+    noise= rng.normal(0, 0.05, (num_subjects, num_regions))*intercept
+    X= intercept+ np.outer(age, slope)+ noise
+    outliers= rng.random((num_subjects, num_regions)) < 0.01
+    X[outliers]*= rng.choice([0.6, 1.4], outliers.sum())
+
+    df= pd.DataFrame(X.round(1), columns=names)
+    df.insert(0, 'Measure:volume', subjects)
+    write_table(df, pjoin(outDir, 'regions.csv'))
+
+    df_demograph= pd.DataFrame({'subjectID': subjects, 'age': age, 'sex': sex, 'group': group})
+    write_table(df_demograph, pjoin(outDir, 'participants.csv'))
+
+    write_lut(pjoin(outDir, 'FreeSurferColorLUT.txt'), num_regions, seed)
+
+    template= pjoin(outDir, 'sub-*', 'freesurfer')
+    if not fstree:
+        return template
+
+    ctx_names= [f'ctx{i+1}' for i in range(max(1, num_regions//2))]
+    for i, id in enumerate(subjects):
+        fsdir= template.replace('*', id)
+        for d in ['stats', 'scripts', 'mri']:
+            makedirs(pjoin(fsdir, d), exist_ok= True)
+
+        etiv= 1.5e6*(1+ rng.normal(0, 0.05))
+        brainseg= X[i].sum()
+        write_aseg_stats(pjoin(fsdir, 'stats', 'aseg.stats'), names, X[i], brainseg, etiv, rng.integers(0, 50))
+        for hemi in ['lh', 'rh']:
+            grayvols= rng.normal(5000, 500, len(ctx_names))
+            thickness= rng.normal(2.5, 0.2, len(ctx_names))
+            write_aparc_stats(pjoin(fsdir, 'stats', f'{hemi}.aparc.stats'), ctx_names, grayvols, thickness,
+                              brainseg, etiv)
+
+        open(pjoin(fsdir, 'scripts', 'recon-all.done'), 'w').close()
+
+        if i < num_volumes:
+            write_volumes(fsdir, num_regions, rng)
+
+    return template
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Generate a synthetic cohort of region based statistics, demographic '
+                                                'info, and FreeSurfer like subject directories for benchmarking')
+
+    parser.add_argument('-o', '--output', required=True, help='a directory where the cohort is generated')
+    parser.add_argument('-n', '--subjects', type=int, default=100, help='number of subjects, default: %(default)s')
+    parser.add_argument('-r', '--regions', type=int, default=50, help='number of regions, default: %(default)s')
+    parser.add_argument('-v', '--volumes', type=int, default=1,
+                        help='number of subjects having synthetic mri/*.mgz volumes, default: %(default)s')
+    parser.add_argument('--no-fstree', action='store_true', help='generate tables only, no subject directories')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='random seed, default: %(default)s')
+
+    args= parser.parse_args()
+    outDir= abspath(args.output)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
+
+    template= make_cohort(outDir, args.subjects, args.regions, args.volumes, not args.no_fstree, args.seed)
+    print('Synthetic cohort generated in', outDir)
+    if not args.no_fstree:
+        print('freesurfer directory template:', template)
@@ -4,15 +4,155 @@ delimiter_dict = {'comma': ',',
                   'space': ' '}
 
 from glob import glob
-from os.path import join as pjoin, isdir
+from os.path import join as pjoin, isdir, splitext, abspath
+from os import getenv
+from time import sleep
+import io
+import atexit
+import threading
+import traceback
+import pandas as pd
+
+# format of tables written by the pipeline: csv, parquet, or feather
+# parquet and feather require pyarrow, csv is kept for export
+TABLE_FORMAT= getenv('TABLE_FORMAT', 'csv')
+table_ext= {'csv': '.csv',
+            'parquet': '.parquet',
+            'feather': '.feather'}
+
+# tables passed to write_later() are written by one background thread, the latest table of a file is written
+# COALESCE seconds after the first request so that rapid successive writes of the same file are written once
+COALESCE= 0.2
+_pending= {}
+_writing= set()
+_cond= threading.Condition()
+_writer= None
 
 def _glob(dir):
 
     items= glob(pjoin(dir, '*'))
     filtered= []
     for item in items:
-        if isdir(item) or sum([item.endswith(ext) for ext in ['.csv','.tsv','.txt']]):
+        if isdir(item) or sum([item.endswith(ext) for ext in ['.csv','.tsv','.txt','.parquet','.feather','.npy']]):
             filtered.append(item)
 
     return filtered
-    
+
+
+def subject_key(id):
+    '''
+    :return: subject id as text without leading zeros of numeric ids, so that 00012 and 12 read from different
+        formats are matched
+    '''
+
+    id= str(id)
+
+    return str(int(id)) if id.isdigit() else id
+
+
+def table_name(prefix, fmt=None):
+    '''
+    :param prefix: path to a table without extension
+    :param fmt: csv, parquet, or feather, default: TABLE_FORMAT environment variable or csv
+    '''
+
+    return prefix+ table_ext[fmt or TABLE_FORMAT]
+
+
+def read_table(filename, sep=',', content=None, **kwargs):
+    '''
+    Read a table according to the extension of filename, sep and kwargs are used for text tables only
+    :param content: bytes of the table when the file is not on disk e.g. dcc.Upload() contents
+    '''
+
+    if content is None:
+        flush(filename)
+
+    src= io.BytesIO(content) if content is not None else filename
+    ext= splitext(filename)[1]
+    if ext=='.parquet':
+        return pd.read_parquet(src)
+    elif ext=='.feather':
+        return pd.read_feather(src)
+    else:
+        return pd.read_csv(src, sep=sep, **kwargs)
+
+
+def write_table(df, filename, sep=','):
+    '''
+    Write a table according to the extension of filename, sep is used for text tables only,
+    a pending write_later() of the same file is dropped
+    '''
+
+    filename_= abspath(filename)
+    with _cond:
+        _pending.pop(filename_, None)
+        while filename_ in _writing:
+            _cond.wait()
+
+    _write(df, filename, sep)
+
+
+def _write(df, filename, sep):
+
+    ext= splitext(filename)[1]
+    if ext=='.parquet':
+        df.to_parquet(filename, index=False)
+    elif ext=='.feather':
+        df.reset_index(drop=True).to_feather(filename)
+    else:
+        df.to_csv(filename, sep=sep, index=False)
+
+
+def _write_behind():
+
+    while True:
+        with _cond:
+            while not _pending:
+                _cond.wait()
+        sleep(COALESCE)
+
+        with _cond:
+            batch= dict(_pending)
+            _pending.clear()
+            _writing.update(batch)
+
+        for filename, (df, sep) in batch.items():
+            try:
+                _write(df, filename, sep)
+            except Exception:
+                traceback.print_exc()
+
+        with _cond:
+            _writing.difference_update(batch)
+            _cond.notify_all()
+
+
+def write_later(df, filename, sep=','):
+    '''
+    Write a table in the background and return immediately, see write_table(),
+    df must not be modified afterwards, read_table() waits for the pending write of the same file
+    '''
+
+    global _writer
+    with _cond:
+        if _writer is None:
+            _writer= threading.Thread(target=_write_behind, daemon=True)
+            _writer.start()
+        _pending[abspath(filename)]= (df, sep)
+        _cond.notify_all()
+
+
+def flush(filename=None):
+    '''
+    Wait until pending writes of filename, or of all files if None, are on disk
+    '''
+
+    if filename is not None:
+        filename= abspath(filename)
+    with _cond:
+        while (filename in _pending or filename in _writing) if filename else (_pending or _writing):
+            _cond.wait()
+
+
+atexit.register(flush)
@@ -2,14 +2,14 @@
 
 from nilearn.plotting import plot_roi
 from nibabel import Nifti1Image
-from nibabel.freesurfer import load as fsload
 from nibabel.freesurfer import MGHImage
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot
 from matplotlib.colors import ListedColormap
 from subprocess import check_call
-from os.path import join as pjoin, abspath, isfile
+import base64
+from os.path import join as pjoin, abspath, basename
 from os import remove, close, getenv
 from tempfile import mkstemp, mkdtemp
 from shutil import rmtree
@@ -18,6 +18,8 @@ import dash_html_components as html
 import webbrowser
 import argparse
 
+from fs_archive import split_archive, exists, load_mgh, read_many
+
 OPACITY = 0.8
 
 def load_lut(lut):
@@ -32,24 +34,54 @@ def load_lut(lut):
 
     return lut_colors
 
+def extract_members(paths, outDir):
+    '''
+    freeview cannot read from an archive, so write the members it opens to outDir
+    :return: paths on disk
+    '''
+
+    if not split_archive(paths[0])[0]:
+        return paths
+
+    extracted= []
+    for path, data in read_many(paths).items():
+        filename= pjoin(outDir, '.'+basename(path))
+        if data is not None:
+            with open(filename, 'wb') as f:
+                f.write(data)
+        extracted.append(filename)
+
+    return extracted
+
+
+def roi_name(table_header):
+    '''
+    :return: segment name of a column header e.g. ctx-lh-insula for lh_insula_volume, and whether it is cortical
+    '''
+
+    if 'lh' in table_header or 'rh' in table_header:
+        hemis, ctx, _ = table_header.split('_')
+        return f'ctx-{hemis}-{ctx}', True
+
+    return table_header, False
+
+
 def render_roi(table_header, fsdir, lut, outDir, method='snapshot'):
 
     # define files according to FreeSurfer structure
+    # fsdir may be within a .tar.gz or .zip archive of the subject
     brain_mgh= pjoin(fsdir, 'mri/brain.mgz')
-    if not isfile(brain_mgh):
+    if not exists(brain_mgh):
         print(brain_mgh, 'does not exist. Provide a valid freesurfer directory')
         exit()
 
 
-    if 'lh' in table_header or 'rh' in table_header:
-        hemis, ctx, _ = table_header.split('_')
-        region = f'ctx-{hemis}-{ctx}'
+    region, cortex= roi_name(table_header)
+    if cortex:
+        hemis= table_header.split('_')[0]
         seg_mgh=pjoin(fsdir, 'mri/aparc+aseg.mgz')
-        cortex= True
     else:
-        region= table_header
         seg_mgh = pjoin(fsdir, 'mri/aseg.mgz')
-        cortex= False
 
     roi_mgh= pjoin(outDir, region+'.mgz')
 
@@ -67,12 +99,12 @@ def render_roi(table_header, fsdir, lut, outDir, method='snapshot'):
         exit()
 
 
-    brain= fsload(brain_mgh)
-    seg= fsload(seg_mgh)
+    brain= load_mgh(brain_mgh)
+    seg= load_mgh(seg_mgh)
 
     brain_nifti= Nifti1Image(brain.get_fdata(), affine= brain.affine)
 
-    roi= (seg.get_fdata()==label)*label
+    roi= ((seg.get_fdata()==label)*label).astype('int32')
     roi_nifti= Nifti1Image(roi, affine= seg.affine)
 
 
@@ -101,6 +133,7 @@ def render_roi(table_header, fsdir, lut, outDir, method='snapshot'):
             # surfaces pial and white
             white_mgh= pjoin(fsdir, f'surf/{hemis}.white')
             pial_mgh= pjoin(fsdir, f'surf/{hemis}.pial')
+            brain_mgh, seg_mgh, white_mgh, pial_mgh= extract_members([brain_mgh, seg_mgh, white_mgh, pial_mgh], outDir)
             cmd= ' '.join([f'freeview -v {brain_mgh} '
                         f'{roi_mgh}:colormap=lut:opacity={OPACITY} '
                         f'{seg_mgh}:colormap=lut:opacity={OPACITY} '
@@ -112,6 +145,7 @@ def render_roi(table_header, fsdir, lut, outDir, method='snapshot'):
             # show aseg
             # background brain.mgz
             # foreground roi.mgz and aseg.mgz
+            brain_mgh, seg_mgh= extract_members([brain_mgh, seg_mgh], outDir)
             cmd= ' '.join([f'freeview -v {brain_mgh} '
                            f'{roi_mgh}:colormap=lut:opacity={OPACITY} '
                            f'{seg_mgh}:colormap=lut:opacity={OPACITY} &'])
@@ -122,6 +156,29 @@ def render_roi(table_header, fsdir, lut, outDir, method='snapshot'):
 
     return cmd
 
+
+def roi_sources(region, fsdir, outDir, method='snapshot'):
+    '''
+    Render region of fsdir using $FREESURFER_HOME/FreeSurferColorLUT.txt for a web page
+    :return: data urls of x, y, and z snapshots (None for freeview), and the command render_roi() printed
+    '''
+
+    fshome= getenv('FREESURFER_HOME', None)
+    if not fshome:
+        raise EnvironmentError('Please set FREESURFER_HOME and then try again')
+    lut= load_lut(pjoin(fshome, 'FreeSurferColorLUT.txt'))
+
+    cmd= render_roi(region, fsdir, lut, outDir, method)
+    if method!='snapshot':
+        return [None, None, None], cmd
+
+    sources= []
+    for m in ['x', 'y', 'z']:
+        with open(pjoin(outDir, f'{roi_name(region)[0]}_{m}.png'), 'rb') as f:
+            sources.append('data:image/png;base64,{}'.format(base64.b64encode(f.read()).decode('ascii')))
+
+    return sources, cmd
+
 if __name__=='__main__':
     # fsdir=r'C:\\Users\\tashr\\Documents\freesurfer'
     # lut = r'C:\\Users\\tashr\\Documents\FreeSurferColorLUT.txt'
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+import argparse
+import ctypes
+import json
+import select
+from ctypes.util import find_library
+from os import O_NONBLOCK, read, stat, makedirs
+from os.path import isfile, isdir, dirname, abspath, join as pjoin
+from time import sleep
+import numpy as np
+import pandas as pd
+
+from util import read_table, write_table, table_name, subject_key
+from stats_reader import read_cohort, cohort_tables, covariates_table, as_list
+from scan_subjects import subjects_index
+from stats2table import stats_prefix
+from scores import summarize
+from correct_for_demography import predict
+from model_store import load_models, model_files
+from results_db import current_run, append_subjects as append_results
+
+# subjects appended by the watcher are recorded in outDir/.watch.json, the web application polls its
+# modification time every WATCH_INTERVAL seconds to refresh summary and table
+STATE= '.watch.json'
+WATCH_INTERVAL= 5
+POLL_INTERVAL= 30
+# inotify(7) events of a new file or directory
+IN_CREATE= 0x100
+IN_MOVED_TO= 0x80
+IN_CLOSE_WRITE= 0x8
+
+
+def watch_version(outDir):
+    '''
+    :return: modification time of outDir/.watch.json, None if no subject has been appended
+    '''
+
+    try:
+        return stat(pjoin(outDir, STATE)).st_mtime
+    except (FileNotFoundError, TypeError):
+        return None
+
+
+def watch_extent(outDir):
+    '''
+    :return: extent of the summaries updated by the watcher
+    '''
+
+    with open(pjoin(outDir, STATE)) as f:
+        return json.load(f)['extent']
+
+
+class _Inotify:
+    '''
+    Directories watched for new entries through libc, events only wake the watcher up,
+    subjects are always discovered by scanning the template
+    '''
+
+    def __init__(self):
+
+        self.libc= ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd= self.libc.inotify_init1(O_NONBLOCK)
+        if self.fd<0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add(self, directory):
+
+        if isdir(directory):
+            self.libc.inotify_add_watch(self.fd, directory.encode(), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE)
+
+    def wait(self, timeout):
+
+        if select.select([self.fd], [], [], timeout)[0]:
+            # drain the events and let the file being written settle
+            sleep(1)
+            try:
+                while read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+def load_state(outDir, score, participants=None, effect=None, extent=2):
+    '''
+    Load the outputs of an earlier analysis of the score table in outDir: stats tables, residuals and models if
+    corrected, zscores, and summaries. Standard scores of new subjects are computed against mean and standard
+    deviation of the subjects analyzed so far, which are not scored again.
+    :return: state of the watcher
+    '''
+
+    tables= {}
+    for name in ['asegstats', 'aparcstats_lh', 'aparcstats_rh', 'covariates', score]:
+        filename= table_name(pjoin(outDir, name))
+        if isfile(filename):
+            tables[name]= read_table(filename, converters={0: str})
+    if score not in tables:
+        raise FileNotFoundError(f'{table_name(pjoin(outDir, score))} does not exist, run stats2table.py first')
+
+    state= {'outDir': outDir, 'score': score, 'tables': tables, 'extent': extent, 'models': None,
+            'residuals': None, 'demograph': None, 'participants': participants, 'effect': effect}
+
+    analyzed= tables[score]
+    if participants:
+        exog= '_'.join(effect.split('+'))
+        state['residuals']= table_name(pjoin(outDir, f'{score}_{exog}_residuals'))
+        analyzed= read_table(state['residuals'], converters={0: str})
+        # saved models with the design of the control group they were fitted on, named after the score table
+        models= load_models(outDir, score)
+        if models is None:
+            raise FileNotFoundError(f'{model_files(outDir, score)[0]} does not exist, analyze {score} first')
+        missing= [region for region in models['regions'] if region not in analyzed.columns]
+        if missing:
+            raise ValueError(f'{missing} of the models of {score} in {outDir} are not in {state["residuals"]}, '
+                             f'analyze {score} again')
+        state['models']= models
+        state['tables']['residuals']= analyzed
+
+    zscores= read_table(table_name(pjoin(outDir, 'zscores')), converters={0: str})
+    if list(zscores.columns[1:])!=list(analyzed.columns[1:]):
+        raise ValueError(f'zscores in {outDir} are not of {score}, analyze {score} first')
+
+    X= analyzed[analyzed.columns[1:]].values.astype(float)
+    state['mean'], state['std']= X.mean(axis=0), X.std(axis=0)
+    state['zscores']= zscores
+    state['summary']= {group_by: summarize(zscores, extent, group_by) for group_by in ['subjects', 'regions']}
+
+    return state
+
+
+def demographics(state):
+    '''
+    :return: demographic info indexed by subject_key() of subject ids, read again if participants file has changed
+    '''
+
+    stamp= stat(state['participants']).st_mtime
+    if state['demograph'] is None or state['demograph'][0]!=stamp:
+        df= read_table(state['participants'], converters={0: str})
+        df.index= [subject_key(id) for id in df[df.columns[0]]]
+        state['demograph']= (stamp, df[df.columns[1:]])
+
+    return state['demograph'][1]
+
+
+def append_subjects(state, cases, subjects, measures, parcs):
+    '''
+    Append rows of new subjects to the stats tables
+    :param subjects: read_cohort() output for each of cases
+    '''
+
+    suffix= len(measures)>1 or len(parcs)>1
+    rows= {stats_prefix(hemi, parc, measure, suffix): df
+           for (hemi, parc, measure), df in cohort_tables(cases, subjects, measures, parcs).items()}
+    rows['covariates']= covariates_table(cases, subjects)
+
+    for name, df in rows.items():
+        if name in state['tables'] and len(df):
+            table= state['tables'][name]
+            # columns of the existing table are kept so that rows of earlier subjects need not be changed
+            df= df.rename(columns={df.columns[0]: table.columns[0]}).reindex(columns=table.columns, fill_value=0)
+            state['tables'][name]= pd.concat([table, df], ignore_index=True)
+
+
+def like_ids(ids, table):
+    '''
+    :return: ids written like those of table, numeric ids lose leading zeros if numeric ids of table have none,
+        so that the id column of a table written by batch.py or correct_for_demography.py is not mixed
+    '''
+
+    numeric= [id for id in table[table.columns[0]].astype(str).tolist() if id.isdigit()]
+    if numeric and all(id==subject_key(id) for id in numeric):
+        return [subject_key(id) for id in ids]
+
+    return list(ids)
+
+
+def score_subjects(state):
+    '''
+    Correct and standardize subjects of the score table that are not in zscores yet, subjects without
+    demographic info are left for later
+    :return: subject ids scored
+    '''
+
+    table, zscores= state['tables'][state['score']], state['zscores']
+    scored= {subject_key(id) for id in zscores[zscores.columns[0]].tolist()}
+    df= table[[subject_key(id) not in scored for id in table[table.columns[0]].tolist()]]
+    regions= zscores.columns[1:]
+
+    if state['participants'] and len(df):
+        demograph= demographics(state)
+        keys= [subject_key(id) for id in df[df.columns[0]].tolist()]
+        df= df[[k in demograph.index for k in keys]]
+        dfcomb= pd.concat([df.reset_index(drop=True),
+                           demograph.loc[[k for k in keys if k in demograph.index]].reset_index(drop=True)], axis=1)
+
+        # residuals=(predicted-given)^2 of the saved control models, regions without a model are kept as they are,
+        # like correct_for_demography.correct()
+        df= df[[df.columns[0]]+ list(regions)].reset_index(drop=True)
+        df[df.columns[0]]= like_ids(df[df.columns[0]], state['tables']['residuals'])
+        models= state['models']
+        df[models['regions']]= (predict(models, dfcomb)- dfcomb[models['regions']].values.astype(float))**2
+        state['tables']['residuals']= pd.concat([state['tables']['residuals'], df], ignore_index=True)
+
+    if not len(df):
+        return []
+
+    X= df[regions].values.astype(float)
+    Z= np.zeros(X.shape)
+    nonzero= state['std']>0
+    Z[:, nonzero]= np.round((X[:, nonzero]- state['mean'][nonzero])/state['std'][nonzero], 4)
+
+    df_scores= pd.DataFrame(Z, columns=regions)
+    df_scores.insert(0, zscores.columns[0], like_ids(df[df.columns[0]], zscores))
+    state['zscores']= pd.concat([zscores, df_scores], ignore_index=True)
+
+    # summaries are updated for the new subjects only
+    new= summarize(df_scores, state['extent'], 'subjects')
+    state['summary']['subjects']= pd.concat([state['summary']['subjects'], new], ignore_index=True)
+
+    by_regions= state['summary']['regions']
+    outliers= abs(Z) > state['extent']
+    subjects= df_scores[df_scores.columns[0]].values
+    for j in np.flatnonzero(outliers.any(axis=0)):
+        earlier= [by_regions.loc[j, 'outliers']] if by_regions.loc[j, 'outliers'] else []
+        by_regions.loc[j, '# of outliers']+= int(outliers[:, j].sum())
+        by_regions.loc[j, 'outliers']= '\n'.join(earlier+ [str(s) for s in subjects[outliers[:, j]]])
+
+    return subjects.tolist()
+
+
+def save_state(state, appended, scored):
+    '''
+    Write tables changed by the watcher and touch outDir/.watch.json for the web application
+    '''
+
+    outDir= state['outDir']
+    for name, df in state['tables'].items():
+        if name=='residuals':
+            if scored:
+                write_table(df, state['residuals'])
+        elif appended:
+            write_table(df, table_name(pjoin(outDir, name)))
+
+    if scored:
+        write_table(state['zscores'], table_name(pjoin(outDir, 'zscores')))
+        run= current_run(outDir)
+        if run:
+            # scored subjects are the last rows of zscores and residuals
+            df_scores= state['zscores'].tail(len(scored))
+            table= state['tables'][state['score']]
+            rows= {subject_key(id): i for i, id in enumerate(table[table.columns[0]].tolist())}
+            df_raw= table.iloc[[rows[subject_key(id)] for id in scored]]
+            df_resid= state['tables']['residuals'].tail(len(scored)) if state['participants'] else None
+            append_results(outDir, run, df_scores, df_raw, df_resid)
+        for group_by, dfs in state['summary'].items():
+            write_table(dfs, table_name(pjoin(outDir, f'outliers-by-{group_by}')))
+
+        with open(pjoin(outDir, STATE), 'w') as f:
+            json.dump({'extent': state['extent'], 'scored': [str(s) for s in scored]}, f)
+
+
+def update(state, template, measures, parcs, ncpu=None):
+    '''
+    Parse stats of subjects having recon-all.done that are not in the score table yet, append them to the tables,
+    and score them
+    :return: ids of subjects appended and scored
+    '''
+
+    outDir= state['outDir']
+    table= state['tables'][state['score']]
+    known= {subject_key(id) for id in table[table.columns[0]].tolist()}
+
+    index= subjects_index(template, outDir)
+    index= index[index['recon_all_done'] & index['stats']]
+    index= index[[subject_key(id) not in known for id in index['subject'].tolist()]]
+
+    cases= index['subject'].tolist()
+    if cases:
+        subjects= read_cohort(index['fsdir'].tolist(), parcs, ncpu)
+        append_subjects(state, cases, subjects, measures, parcs)
+
+    scored= score_subjects(state)
+    save_state(state, cases, scored)
+
+    return cases, scored
+
+
+def watch(state, template, measures, parcs, interval=POLL_INTERVAL, poll=False, ncpu=None):
+    '''
+    Update state whenever a subject directory or file appears under template, or every interval seconds
+    '''
+
+    inotify= None
+    if not poll:
+        try:
+            inotify= _Inotify()
+        except (OSError, AttributeError):
+            print('inotify is not available, polling every', interval, 'seconds')
+
+    while True:
+        cases, scored= update(state, template, measures, parcs, ncpu)
+        if cases or scored:
+            print(f'Appended {len(cases)} subjects, scored {len(scored)} subjects: {" ".join(map(str, scored))}')
+
+        if inotify:
+            # parent of subject directories, and scripts directory of subjects that have not finished yet
+            inotify.add(dirname(template.partition('*')[0]))
+            index= subjects_index(template, state['outDir'])
+            for fsdir in index.loc[~index['recon_all_done'], 'fsdir']:
+                inotify.add(fsdir)
+                inotify.add(pjoin(fsdir, 'scripts'))
+            inotify.wait(interval)
+        else:
+            sleep(interval)
+
+
+if __name__ == '__main__':
+
+    parser= argparse.ArgumentParser(description='Watch freesurfer directories for new recon-all.done, append their stats '
+                                                'to the tables in the output directory, and score them against the '
+                                                'analysis of the existing subjects without analyzing them again',
+                                    formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('-t', '--template', required=True,
+                        help='freesurfer directory pattern enclosed in double quotes e.g. '
+                             '"/path/to/derivatives/pnlpipe/sub-*/anat/freesurfer"')
+    parser.add_argument('-o', '--output', required=True,
+                        help='a directory having stats2table.py tables and the analysis of --score table\n'
+                             'by the web application, batch.py, or demography-effect.py')
+    parser.add_argument('-s', '--score', default='asegstats',
+                        help='table to score new subjects in, its analysis must be in --output, default: %(default)s')
+    parser.add_argument('-m', '--measure', default='volume', help='measures of stats2table.py, default: %(default)s')
+    parser.add_argument('-p', '--parc', default='aparc', help='parcellations of stats2table.py, default: %(default)s')
+    parser.add_argument('--participants', help='demographic info, new subjects are corrected by the saved models '
+                                               'if provided, subjects missing from it are scored once it has them')
+    parser.add_argument('--effect', help='effect of the saved models e.g. age+sex, required with --participants')
+    parser.add_argument('-x', '--extent', type=float, default=2, help='acceptable zscore, default: %(default)s')
+    parser.add_argument('-i', '--interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between scans if inotify is not available, or no event has occurred, '
+                             'default: %(default)s')
+    parser.add_argument('--poll', action='store_true', help='scan every --interval seconds without inotify')
+    parser.add_argument('--once', action='store_true', help='append and score new subjects once and exit')
+    parser.add_argument('-n', '--ncpu', type=int, default=None,
+                        help='number of processes for parsing stats files, default: number of cores')
+
+    args= parser.parse_args()
+    if args.participants and not args.effect:
+        parser.error('--effect is required with --participants')
+
+    outDir= abspath(args.output)
+    if not isdir(outDir):
+        makedirs(outDir, exist_ok= True)
+
+    measures, parcs= as_list(args.measure.split(',')), as_list(args.parc.split(','))
+    state= load_state(outDir, args.score, abspath(args.participants) if args.participants else None, args.effect,
+                      args.extent)
+
+    if args.once:
+        cases, scored= update(state, args.template, measures, parcs, args.ncpu)
+        print(f'Appended {len(cases)} subjects, scored {len(scored)} subjects')
+    else:
+        watch(state, args.template, measures, parcs, args.interval, args.poll, args.ncpu)